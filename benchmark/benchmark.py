@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# benchmark.py - offline benchmark of mapillary_takeout.py against the mock server
+#
+# Runs the takeout for every scenario against a local mock of the Mapillary API
+# and S3 and reports throughput, server side image latency percentiles and the
+# peak RSS of the takeout process. Arguments after "--" are passed to
+# mapillary_takeout.py, e.g. to compare engines or thread counts:
+#
+#   benchmark.py -- --threads 32
+#   benchmark.py --scenario errors --scenario expiry -- --engine async
+#   benchmark.py --save before.json && benchmark.py --baseline before.json
+#
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_mapillary import MockMapillary, add_mock_arguments, mock_options
+
+TAKEOUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mapillary_takeout.py")
+
+# scenario name: mock options which differ from the command line defaults
+SCENARIOS = {
+    "baseline": {},
+    "latency": {"latency": 0.05},
+    "slow-link": {"bandwidth": 20},
+    "errors": {"error_rate": 0.05},
+    "truncated": {"truncate_rate": 0.05},
+    # the run lasts several URL lifetimes: expired URLs and background refreshes
+    "expiry": {"url_ttl": 1, "latency": 0.02, "bandwidth": 10},
+    "large-images": {"image_size_min": 5000000, "image_size_max": 12000000, "images": 10},
+}
+
+
+def run_takeout(endpoint, output_folder, takeout_args):
+    # Runs the takeout in a child process, returns (end event, peak RSS in MB, exit code)
+    events = os.path.join(output_folder, "events.jsonl")
+    command = [
+        sys.executable, TAKEOUT,
+        "--api-endpoint", endpoint,
+        "--metrics-file", events,
+    ] + takeout_args + ["mock@example.com", "mock", "mock", os.path.join(output_folder, "takeout")]
+
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    peak_rss = None
+    if hasattr(os, "wait4"):
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # kilobytes on Linux, bytes on macOS
+        peak_rss = rusage.ru_maxrss / 1024
+        if sys.platform == "darwin":
+            peak_rss /= 1024
+    else:
+        process.wait()
+
+    end = {}
+    if os.path.exists(events):
+        with open(events) as f:
+            for line in f:
+                event = json.loads(line)
+                if event["event"] == "end":
+                    end = event
+    return end, peak_rss, process.returncode
+
+
+def run_scenario(name, options, takeout_args, keep):
+    mock = MockMapillary(**options).start()
+    output_folder = tempfile.mkdtemp(prefix="takeout-benchmark-")
+    try:
+        start = time.time()
+        end, peak_rss, returncode = run_takeout(mock.endpoint, output_folder, takeout_args)
+        elapsed = time.time() - start
+    finally:
+        stats = mock.stats.result()
+        mock.stop()
+        if keep:
+            print("Kept output of %r in %s" % (name, output_folder))
+        else:
+            shutil.rmtree(output_folder, ignore_errors=True)
+
+    duration = end.get("duration") or elapsed
+    images = end.get("images_downloaded", 0)
+    nb_bytes = end.get("bytes_downloaded", 0)
+    expected = mock.config.sequences * mock.config.images
+    return {
+        "scenario": name,
+        "exit": returncode,
+        "images": images,
+        "expected": expected,
+        "mbytes": nb_bytes / 1024 / 1024,
+        "seconds": duration,
+        "mbytes_per_second": nb_bytes / 1024 / 1024 / duration if duration else 0,
+        "images_per_second": images / duration if duration else 0,
+        "p50": stats["p50"],
+        "p90": stats["p90"],
+        "p99": stats["p99"],
+        "peak_rss_mb": peak_rss,
+        "retries": end.get("retries", 0),
+        "urls_expired": end.get("urls_expired", 0),
+        "urls_refreshed": end.get("urls_refreshed", 0),
+        "server": stats["counters"],
+    }
+
+
+def ms(seconds):
+    return "%7.1f" % (seconds * 1000) if seconds is not None else "      -"
+
+
+def print_results(results, baseline):
+    print("%-13s %9s %9s %8s %8s %7s %7s %7s %7s %8s %7s %7s %7s" % (
+        "scenario", "images", "MB", "sec", "MB/s", "img/s", "p50 ms", "p90 ms", "p99 ms", "RSS MB", "retries",
+        "expired", "refresh"))
+    for r in results:
+        line = "%-13s %4d/%-4d %9.1f %8.1f %8.1f %7.1f %s %s %s %8s %7d %7d %7d" % (
+            r["scenario"], r["images"], r["expected"], r["mbytes"], r["seconds"],
+            r["mbytes_per_second"], r["images_per_second"],
+            ms(r["p50"]), ms(r["p90"]), ms(r["p99"]),
+            "%8.1f" % r["peak_rss_mb"] if r["peak_rss_mb"] is not None else "-",
+            r["retries"], r.get("urls_expired", 0), r.get("urls_refreshed", 0))
+        if r["scenario"] in baseline:
+            before = baseline[r["scenario"]]["mbytes_per_second"]
+            if before:
+                line += "  %+5.1f%%" % ((r["mbytes_per_second"] - before) / before * 100)
+        print(line, flush=True)
+
+
+def regressions(results, baseline, tolerance):
+    # scenarios which are slower than the baseline or incomplete
+    failed = []
+    for r in results:
+        if r["exit"] != 0 or r["images"] < r["expected"]:
+            failed.append("%s: %d/%d images, exit code %s" % (r["scenario"], r["images"], r["expected"], r["exit"]))
+        before = baseline.get(r["scenario"])
+        if before and r["mbytes_per_second"] < before["mbytes_per_second"] * (1 - tolerance):
+            failed.append("%s: %2.1f MB/s, baseline %2.1f MB/s" % (
+                r["scenario"], r["mbytes_per_second"], before["mbytes_per_second"]))
+    return failed
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    takeout_args = []
+    if "--" in argv:
+        takeout_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Offline benchmark of mapillary_takeout.py against a mock Mapillary server")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, can be repeated, default: all")
+    parser.add_argument("--keep", action="store_true", help="keep the downloaded images")
+    parser.add_argument("--save", metavar="FILE", help="save the results as json")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed throughput loss against the baseline, default: 0.1")
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)}
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        options = mock_options(args)
+        options.update(SCENARIOS[name])
+        print("Running scenario %r ..." % name, flush=True)
+        results.append(run_scenario(name, options, takeout_args, args.keep))
+
+    print("")
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = regressions(results, baseline, args.tolerance)
+    for message in failed:
+        print("Regression: %s" % message)
+    sys.exit(1 if failed else 0)
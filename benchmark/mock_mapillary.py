@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+#
+# mock_mapillary.py - local stand-in for the Mapillary v3 API and the S3 image store
+#
+# Implements the endpoints used by mapillary_takeout.py:
+#   POST /v2/ua/login            -> {"token": ...}
+#   GET  /v3/sequences           -> paginated features with "Link: <...>; rel=next"
+#   GET  /v3/model.json          -> imageByKey original_url with signed image URLs
+#   GET  /images/<key>.jpg       -> image data, 403 "Request has expired" after the URL TTL,
+#                                   single byte ranges are answered with 206
+#   GET  /stats                  -> request counters and image latency percentiles as json
+#
+# usage: mock_mapillary.py --port 8080 --latency 0.05 --error-rate 0.01
+#        mapillary_takeout.py --api-endpoint http://127.0.0.1:8080 user pass user /tmp/out
+#
+
+import argparse
+import calendar
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AWS_EXPIRED = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>AccessDenied</Code>'
+    b"<Message>Request has expired</Message></Error>"
+)
+
+TOKEN = "mock-token"
+
+# image data is sent in chunks of this size, the bandwidth limit is applied per chunk
+CHUNK_SIZE = 64 * 1024
+
+
+##################################################################################################
+# data
+#
+class MockConfig:
+    def __init__(self, **kwargs):
+        self.sequences = 10
+        self.images = 100
+        self.image_size_min = 200000
+        self.image_size_max = 200000
+        self.per_page = 100
+        # seconds before every response
+        self.latency = 0.0
+        # Mbit/s per image connection, 0: unlimited
+        self.bandwidth = 0
+        # share of image requests answered with HTTP 500
+        self.error_rate = 0.0
+        # share of image responses which are cut off after half of the data
+        self.truncate_rate = 0.0
+        # lifetime of signed image URLs in seconds
+        self.url_ttl = 3600
+        self.seed = 1
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise TypeError("unknown mock option %r" % key)
+            setattr(self, key, value)
+
+
+class MockData:
+    # Deterministic sequences and images, generated from the config
+
+    def __init__(self, config):
+        self.config = config
+        rnd = random.Random(config.seed)
+        self.filler = bytes(rnd.getrandbits(8) for i in range(min(config.image_size_max, 1 << 20)))
+        self.features = []
+        self.image_sizes = {}
+        self.etags = {}
+
+        for i in range(config.sequences):
+            day = 1 + i % 28
+            month = 1 + (i // 28) % 12
+            year = 2015 + i // (28 * 12)
+            captured_at = "%04d-%02d-%02dT10:%02d:00.000Z" % (year, month, day, i % 60)
+            created_at = "%04d-%02d-%02dT18:%02d:00.000Z" % (year, month, day, i % 60)
+            image_keys = []
+            coordinates = []
+            for j in range(config.images):
+                image_key = "mock%05di%05d" % (i, j)
+                image_keys.append(image_key)
+                coordinates.append([13.0 + i * 0.01 + j * 0.0001, 52.0 + j * 0.0001])
+                self.image_sizes[image_key] = rnd.randint(config.image_size_min, config.image_size_max)
+            self.features.append(
+                {
+                    "type": "Feature",
+                    "properties": {
+                        "key": "mockseq%05d" % i,
+                        "camera_make": "MockCam",
+                        "captured_at": captured_at,
+                        "created_at": created_at,
+                        "username": "mock",
+                        "coordinateProperties": {
+                            "cas": [0.0] * config.images,
+                            "image_keys": image_keys,
+                        },
+                    },
+                    "geometry": {"type": "LineString", "coordinates": coordinates},
+                }
+            )
+
+        # the API lists the newest sequences first
+        self.features.sort(key=lambda f: f["properties"]["created_at"], reverse=True)
+
+    def image(self, image_key):
+        # JPEG start and end markers around filler data
+        size = self.image_sizes[image_key]
+        body = bytearray(b"\xff\xd8")
+        while len(body) < size - 2:
+            body += self.filler[: size - 2 - len(body)]
+        body += b"\xff\xd9"
+        return bytes(body)
+
+    def etag(self, image_key):
+        # MD5 of the content, like S3 for single part uploads
+        if image_key not in self.etags:
+            self.etags[image_key] = '"%s"' % hashlib.md5(self.image(image_key)).hexdigest()
+        return self.etags[image_key]
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.latencies = []
+
+    def inc(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def observe(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def result(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            result = {"counters": dict(self.counters), "images": len(latencies)}
+        for p in (50, 90, 99):
+            if latencies:
+                result["p%d" % p] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+            else:
+                result["p%d" % p] = None
+        return result
+
+
+##################################################################################################
+# server
+#
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, data, headers=None):
+        self.send(200, json.dumps(data).encode(), headers=headers)
+
+    def authorized(self):
+        if self.headers.get("Authorization") != "Bearer " + TOKEN:
+            self.send(401, b'{"message": "unauthorized"}')
+            return False
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        url = urllib.parse.urlparse(self.path)
+        time.sleep(self.mock.config.latency)
+        if url.path == "/v2/ua/login":
+            self.mock.stats.inc("login")
+            self.send_json({"token": TOKEN})
+        else:
+            self.send(404, b"{}")
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/stats":
+            self.send_json(self.mock.stats.result())
+            if "reset" in query:
+                self.mock.stats.reset()
+            return
+
+        self.start = time.time()
+        time.sleep(self.mock.config.latency)
+        if url.path == "/v3/sequences":
+            self.sequences(query)
+        elif url.path == "/v3/model.json":
+            self.model(query)
+        elif url.path.startswith("/images/"):
+            self.image(url.path[len("/images/"):].replace(".jpg", ""), query)
+        else:
+            self.send(404, b"{}")
+
+    def sequences(self, query):
+        if not self.authorized():
+            return
+        self.mock.stats.inc("sequences")
+        config = self.mock.config
+        features = self.mock.data.features
+        start_time = query.get("start_time", [None])[0]
+        end_time = query.get("end_time", [None])[0]
+        if start_time:
+            features = [f for f in features if f["properties"]["captured_at"] >= start_time]
+        if end_time:
+            features = [f for f in features if f["properties"]["captured_at"] < end_time]
+
+        per_page = int(query.get("per_page", [config.per_page])[0])
+        page = int(query.get("page", ["0"])[0])
+        headers = {}
+        if (page + 1) * per_page < len(features):
+            params = {k: v[0] for k, v in query.items()}
+            params["page"] = page + 1
+            next_url = "http://%s/v3/sequences?%s" % (self.headers["Host"], urllib.parse.urlencode(params))
+            headers["Link"] = '<%s>; rel="next"' % next_url
+        self.send_json(
+            {"type": "FeatureCollection", "features": features[page * per_page : (page + 1) * per_page]},
+            headers,
+        )
+
+    def model(self, query):
+        if not self.authorized():
+            return
+        self.mock.stats.inc("model")
+        paths = json.loads(query["paths"][0])
+        signed = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        images = {}
+        for image_key in paths[0][1]:
+            if image_key not in self.mock.data.image_sizes:
+                continue
+            images[image_key] = {
+                "original_url": {
+                    "$type": "atom",
+                    "value": "http://%s/images/%s.jpg?X-Amz-Date=%s&X-Amz-Expires=%d&X-Amz-Signature=mock"
+                    % (self.headers["Host"], image_key, signed, self.mock.config.url_ttl),
+                }
+            }
+        self.send_json({"jsonGraph": {"imageByKey": images}})
+
+    def image(self, image_key, query):
+        config = self.mock.config
+        if image_key not in self.mock.data.image_sizes:
+            self.send(404, b"")
+            return
+        self.mock.stats.inc("image_requests")
+
+        try:
+            signed = calendar.timegm(time.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ"))
+            expires = int(query["X-Amz-Expires"][0])
+        except (KeyError, ValueError):
+            self.send(403, b"", "application/xml")
+            return
+        if time.time() > signed + expires:
+            self.mock.stats.inc("image_expired")
+            self.send(403, AWS_EXPIRED, "application/xml")
+            return
+
+        if random.random() < config.error_rate:
+            self.mock.stats.inc("image_errors")
+            self.send(500, b"mock error", "text/plain")
+            return
+
+        body = self.mock.data.image(image_key)
+        size = len(body)
+        byte_range = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if byte_range and int(byte_range.group(1)) < size:
+            self.mock.stats.inc("image_ranges")
+            first = int(byte_range.group(1))
+            last = min(int(byte_range.group(2) or size - 1), size - 1)
+            body = body[first : last + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.mock.data.etag(image_key))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        if random.random() < config.truncate_rate:
+            self.mock.stats.inc("image_truncated")
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+
+        chunk_time = CHUNK_SIZE * 8 / (config.bandwidth * 1000 * 1000) if config.bandwidth else 0
+        for offset in range(0, len(body), CHUNK_SIZE):
+            self.wfile.write(body[offset : offset + CHUNK_SIZE])
+            if chunk_time:
+                time.sleep(chunk_time)
+        self.mock.stats.observe(time.time() - self.start)
+
+
+class MockServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 drops connections of high concurrency runs
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockMapillary:
+    # Mock server running in a background thread
+
+    def __init__(self, host="127.0.0.1", port=0, **options):
+        self.config = MockConfig(**options)
+        self.data = MockData(self.config)
+        self.stats = MockStats()
+        self.server = MockServer((host, port), MockHandler)
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_mock_arguments(parser):
+    # command line options shared with the benchmark
+    parser.add_argument("--sequences", type=int, default=10, help="number of sequences, default: 10")
+    parser.add_argument("--images", type=int, default=100, help="images per sequence, default: 100")
+    parser.add_argument("--image-size", default="200000", metavar="BYTES[-BYTES]", help="image size or size range, default: 200000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response, default: 0")
+    parser.add_argument("--bandwidth", type=float, default=0, metavar="Mbit/s", help="bandwidth per image connection, 0: unlimited, default: 0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of image requests failing with HTTP 500, default: 0")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="share of image responses cut off half way, default: 0")
+    parser.add_argument("--url-ttl", type=int, default=3600, help="lifetime of signed image URLs in seconds, default: 3600")
+
+
+def mock_options(args):
+    sizes = [int(x) for x in args.image_size.split("-", 1)]
+    return dict(
+        sequences=args.sequences,
+        images=args.images,
+        image_size_min=sizes[0],
+        image_size_max=sizes[-1],
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        truncate_rate=args.truncate_rate,
+        url_ttl=args.url_ttl,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the Mapillary API and S3 image store")
+    parser.add_argument("--host", default="127.0.0.1", help="listen address, default: 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="listen port, default: 8080")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockMapillary(args.host, args.port, **mock_options(args))
+    print("Mock Mapillary API on %s: %d sequences, %d images" % (mock.endpoint, args.sequences, args.sequences * args.images), flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
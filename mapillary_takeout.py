@@ -1,15 +1,45 @@
 #!/usr/bin/env python3
 
 import argparse
+import calendar
+import collections
+import hashlib
+import heapq
+import importlib
 import json
+import mmap
 import os
+import queue
+import random
 import re
-import requests
+import signal
+import socket
+import sqlite3
+import shutil
+import subprocess
 import sys
+import tarfile
+import threading
 import time
+import urllib.parse
+import zlib
 from pprint import pprint
 
-from multiprocessing.pool import ThreadPool
+
+class _LazyModule:
+    # Imports a module on first use and replaces itself with it, the
+    # commands which don't download start without loading requests or asyncio
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+asyncio = _LazyModule("asyncio")
+requests = _LazyModule("requests")
 
 ##################################################################################################
 # config
@@ -18,6 +48,15 @@ VERSION = "1.2"
 
 NUM_THREADS = 16
 
+# download engine: "threads" or "async" (requires aiohttp)
+ENGINE = "threads"
+
+# downloads in flight for the async engine
+ASYNC_CONCURRENCY = 512
+
+# the async engine writes the downloaded data in blocks of this size
+ASYNC_WRITE_SIZE = 256 * 1024
+
 # mapillary_tools client_id
 CLIENT_ID = "MkJKbDA0bnZuZlcxeTJHTmFqN3g1dzo1YTM0NjRkM2EyZGU5MzBh"
 
@@ -27,11 +66,39 @@ SEQUENCES_PER_PAGE = "100"
 # 220 max
 REQUESTS_PER_CALL = 210
 
-# Number of retries for a sequence
-# Normally a sequence is limited to 1000 images, but this is no longer true for the iPhone
-# Given the low reliability of AWS S3 (<0.99) we need to set an insanse high retry value
-# to download 3k of images
-SEQUENCE_DL_MAX_RETRIES = 128
+# adapt the number of active download workers to errors, timeouts,
+# latency and throughput, between ADAPTIVE_MIN and ADAPTIVE_MAX workers
+ADAPTIVE = False
+ADAPTIVE_MIN = 1
+# 0: 128 for the thread engine, 10000 for the async engine
+ADAPTIVE_MAX = 0
+ADAPTIVE_INTERVAL = 5
+ADAPTIVE_MIN_SAMPLES = 10
+ADAPTIVE_STEP = 1
+ADAPTIVE_DECREASE = 0.7
+ADAPTIVE_MAX_ERROR_RATE = 0.05
+ADAPTIVE_MAX_TIMEOUT_RATE = 0.02
+ADAPTIVE_LATENCY_FACTOR = 2
+
+# number of model requests in flight to resolve source URLs
+URL_THREADS = 4
+
+# Number of download attempts per image
+# Every image is retried on its own with an exponential backoff, so a few
+# bad images of a 3k images iPhone sequence no longer restart the whole sequence
+IMAGE_DL_MAX_RETRIES = 16
+
+# backoff before the next attempt of an image in seconds: base * 2^(attempt-1), max.
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 60
+
+# collect expired URLs this long in seconds before asking the model again
+URL_REFRESH_DELAY = 0.5
+
+# refresh signed URLs in the background this many seconds before they expire
+# (at most a quarter of their lifetime), checked every URL_REFRESH_CHECK seconds
+URL_REFRESH_MARGIN = 60
+URL_REFRESH_CHECK = 1
 
 # verbose level 0..4
 # 0: only import messages, like errors
@@ -45,9 +112,28 @@ DEBUG = 0
 # this will raise an exception for a download, and we retry to download the image later
 DOWNLOAD_FILE_TIMEOUT=5
 
+# read buffer for streaming images to disk, in bytes
+DOWNLOAD_BUFFER_SIZE = 64 * 1024
+
+# download bandwidth of all workers together in Mbit/s, 0: unlimited
+MAX_BANDWIDTH = 0
+
+# login, sequence and model requests per second, 0: unlimited
+META_RATE = 0
+
+# file in the output folder to change the limits of a running takeout
+CONTROL_FILE = ".mapillary_takeout.control"
+
 # timeout for login and sequences
 META_TIMEOUT=60
 
+# keep-alive HTTP connections per host, shared by all threads
+# 0: same as the number of threads
+HTTP_POOL_SIZE = 0
+
+# number of hosts with an open connection pool (API endpoint + S3 buckets)
+HTTP_POOL_HOSTS = 32
+
 API_ENDPOINT = "https://a.mapillary.com"
 
 LOGIN_URL = API_ENDPOINT + "/v2/ua/login?client_id=" + CLIENT_ID
@@ -69,13 +155,95 @@ DRY_RUN = False
 # Disabled by default to be compatible with older versions.
 SUBFOLDER = False
 
-# count downloads per sequence
-_DOWNLOAD_SEQUENCE_SIZE = 0
-_DOWNLOAD_TOTAL_SIZE = 0
+# image database in the output folder, used to resume a takeout
+MANIFEST_FILE = ".mapillary_takeout.sqlite"
+
+# commit the manifest after this number of downloaded images
+MANIFEST_COMMIT_INTERVAL = 100
+
+# WAL journal of the manifest, only safe if all workers run on the same host.
+# Workers on several hosts sharing the output folder over NFS need it disabled.
+MANIFEST_WAL = True
+
+# Sharded takeout: several processes or hosts download into the same output
+# folder. The sequences are split into SHARDS shards by sequence key or by
+# capture date, every worker starts with its own shard (0-based).
+SHARD = 0
+SHARDS = 1
+SHARD_BY = "key"
+
+# With leases workers claim every sequence in the manifest before downloading
+# it and continue with the sequences of the other shards once their own shard
+# is done. Leases of crashed workers expire after LEASE_TTL seconds.
+LEASES = False
+WORKER_ID = socket.gethostname() + ":" + str(os.getpid())
+LEASE_TTL = 300
+
+# seconds between checks for sequences leased by other workers
+LEASE_RETRY = 10
+
+# ignore the cached sequence list and fetch all sequences again
+FULL_REFRESH = False
+
+# order of the sequences: "newest" or "oldest" created first, "smallest"
+# download first or by capture "date". The newest sequences are downloaded
+# while the list is fetched, with up to LISTING_PREFETCH sequences fetched
+# ahead, the other orders wait for the full sequence list.
+ORDER = "newest"
+LISTING_PREFETCH = 1000
+# attempts of a failing page of the sequence list, after that the list is
+# incomplete and the next run fetches it again
+LISTING_RETRIES = 5
+
+# budgets of a run, 0: unlimited. Sequences which are not expected to fit
+# are skipped, at MAX_DURATION seconds the download stops.
+MAX_BYTES = 0
+MAX_DURATION = 0
+
+# cross-check the manifest with the files on disk
+VERIFY = False
+
+# verify command: processes which scan the images, 0: one per CPU
+VERIFY_PROCESSES = 0
+# images per task of a verify process
+VERIFY_BATCH = 256
+# compare the images with the size and ETag on the server
+VERIFY_REMOTE = False
+VERIFY_CHECKSUM = False
+# download the deleted failing images again right away instead of with the next takeout
+VERIFY_REPAIR = False
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+# bytes at the end of an image which are searched for the JPEG end marker,
+# some cameras pad their images after it
+JPEG_EOI_WINDOW = 1024
+
+# JSON lines event log and Prometheus text file, disabled by default
+METRICS_FILE = None
+PROMETHEUS_FILE = None
+
+# seconds between live rate updates
+METRICS_INTERVAL = 10
+
+# Append the images to tar shards per day or per sequence instead of
+# writing one file per image, None: one file per image
+PACK_BY = None
+# shards are closed before they grow larger than this
+PACK_SIZE = 4 * 1024 * 1024 * 1024
+
+# journal of the migrate-layout command in the output folder
+MIGRATE_JOURNAL = ".mapillary_takeout.migrate"
 
 # estimates
 AVERAGE_IMAGE_SIZE=2500000
 
+# dry run: share of the images whose size is probed on the server, 0: none
+SIZE_SAMPLE = 0
+
+# the download time estimate uses the throughput of this number of previous runs
+THROUGHPUT_RUNS = 5
+
 
 ##################################################################################################
 # exception classes
@@ -89,98 +257,562 @@ class DownloadException(Exception):
 class URLExpireException(Exception):
     pass
 
+class TakeoutError(Exception):
+    # The takeout can not continue, the command line exits with code
+    def __init__(self, message, code=-1):
+        super().__init__(message)
+        self.code = code
+
+
+##################################################################################################
+# metrics
+#
+class Metrics:
+    # Thread-safe counters, per phase latency histograms and live rates.
+    # Events are appended as JSON lines to METRICS_FILE, the counters and
+    # histograms are written in Prometheus text format to PROMETHEUS_FILE.
+
+    PHASES = ("login", "sequences", "resolve", "download", "write")
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.events = None
+        # callbacks which get every event as a dict, see TakeoutClient
+        self.listeners = []
+        self.last_report = (self.started, 0, 0)
+        self.rates = (0.0, 0.0)
+
+    def open(self, events_path):
+        if events_path:
+            self.events = open(events_path, "a")
+
+    def close(self):
+        with self.lock:
+            if self.events:
+                self.events.close()
+                self.events = None
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = [[0] * len(self.BUCKETS), 0, 0.0]
+            for i, bucket in enumerate(self.BUCKETS):
+                if seconds <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def timer(self, phase):
+        return _MetricsTimer(self, phase)
+
+    def notify(self, kind, **fields):
+        # passes an event to the listeners only, for frequent progress events
+        # which don't belong into METRICS_FILE
+        if not self.listeners:
+            return
+        fields["ts"] = round(time.time(), 3)
+        fields["event"] = kind
+        for listener in self.listeners:
+            listener(dict(fields))
+
+    def event(self, kind, **fields):
+        if self.events is None and not self.listeners:
+            return
+        self.notify(kind, **fields)
+        fields["ts"] = round(time.time(), 3)
+        fields["event"] = kind
+        line = json.dumps(fields, separators=(",", ":"))
+        with self.lock:
+            if self.events:
+                self.events.write(line + "\n")
+                self.events.flush()
+
+    def report(self):
+        # Updates the live rates, about once every METRICS_INTERVAL seconds
+        now = time.time()
+        with self.lock:
+            last_time, last_bytes, last_images = self.last_report
+            if now - last_time < METRICS_INTERVAL:
+                return
+            nb_bytes = self.counters.get("bytes_downloaded", 0)
+            nb_images = self.counters.get("images_downloaded", 0)
+            self.rates = (
+                (nb_bytes - last_bytes) / (now - last_time) / 1024 / 1024,
+                (nb_images - last_images) / (now - last_time),
+            )
+            self.last_report = (now, nb_bytes, nb_images)
+
+        mbytes, images = self.rates
+        if DEBUG >= 1:
+            print("Download rate: %2.1f MB/s, %2.1f images/s" % (mbytes, images), flush=True)
+        self.event("progress", mbytes_per_second=round(mbytes, 3), images_per_second=round(images, 3),
+                   **self.snapshot())
+        if PROMETHEUS_FILE:
+            self.write_prometheus(PROMETHEUS_FILE)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def write_prometheus(self, path):
+        prefix = "mapillary_takeout_"
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append("# TYPE %s%s_total counter" % (prefix, name))
+                lines.append("%s%s_total %s" % (prefix, name, self.counters[name]))
+            mbytes, images = self.rates
+            lines.append("# TYPE %sdownload_mbytes_per_second gauge" % prefix)
+            lines.append("%sdownload_mbytes_per_second %f" % (prefix, mbytes))
+            lines.append("# TYPE %sdownload_images_per_second gauge" % prefix)
+            lines.append("%sdownload_images_per_second %f" % (prefix, images))
+            lines.append("# TYPE %sphase_seconds histogram" % prefix)
+            for phase in sorted(self.histograms):
+                buckets, count, total = self.histograms[phase]
+                for bucket, value in zip(self.BUCKETS, buckets):
+                    lines.append('%sphase_seconds_bucket{phase="%s",le="%s"} %d' % (prefix, phase, bucket, value))
+                lines.append('%sphase_seconds_bucket{phase="%s",le="+Inf"} %d' % (prefix, phase, count))
+                lines.append('%sphase_seconds_sum{phase="%s"} %f' % (prefix, phase, total))
+                lines.append('%sphase_seconds_count{phase="%s"} %d' % (prefix, phase, count))
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+class _MetricsTimer:
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.phase, time.time() - self.start)
+        return False
+
+
+_METRICS = Metrics()
+
+
+##################################################################################################
+# rate limits
+#
+class RateLimiter:
+    # Token bucket shared by all threads. reserve() takes the tokens right
+    # away and returns how long the caller has to wait, so the thread engine
+    # can sleep and the async engine can await the delay.
+    # A rate of 0 means unlimited.
+
+    def __init__(self, rate=0, burst=1.0):
+        self.lock = threading.Lock()
+        self.burst = burst
+        self.rate = 0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.capacity())
+
+    def capacity(self):
+        return max(self.rate * self.burst, 1)
+
+    def _refill(self):
+        # the caller holds the lock
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity(), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, amount=1):
+        with self.lock:
+            if not self.rate:
+                return 0
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def consume(self, amount=1):
+        delay = self.reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+
+# shared by all download workers, in bytes per second
+_BANDWIDTH_LIMITER = RateLimiter()
+
+# login, sequences and model requests per second
+_META_LIMITER = RateLimiter()
+
+# set by Takeout.cancel(), the takeout stops at its next check
+_STOP = threading.Event()
+
+
+def set_max_bandwidth(mbits):
+    global MAX_BANDWIDTH
+    MAX_BANDWIDTH = mbits
+    _BANDWIDTH_LIMITER.set_rate(mbits * 1000 * 1000 / 8)
+
+
+def set_meta_rate(rps):
+    global META_RATE
+    META_RATE = rps
+    _META_LIMITER.set_rate(rps)
+
+
+class RuntimeControl:
+    # Re-reads the limits from a control file in the output folder while the
+    # takeout is running, when the file changes or on SIGHUP. Example:
+    #
+    #   max-bandwidth = 50
+    #   meta-rate = 2
+
+    def __init__(self, output_folder):
+        self.path = os.path.join(output_folder, CONTROL_FILE)
+        self.mtime = None
+        self.reload = False
+        self.previous_handler = None
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGHUP, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self.reload = True
+
+    def close(self):
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGHUP, self.previous_handler)
+            self.previous_handler = None
+
+    def poll(self):
+        _METRICS.report()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime and not self.reload:
+            return
+        self.mtime = mtime
+        self.reload = False
+
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except OSError as e:
+            print("Cannot read control file %r: %s" % (self.path, e))
+            return
+
+        for line in lines:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            try:
+                key, value = [x.strip() for x in line.split("=", 1)]
+                value = float(value)
+            except ValueError:
+                print("Illegal line in control file %r: %r, ignored" % (self.path, line))
+                continue
+            if value < 0:
+                print("Negative value in control file %r: %r, ignored" % (self.path, line))
+            elif key == "max-bandwidth":
+                if value != MAX_BANDWIDTH:
+                    print("Max. bandwidth: %s Mbit/s" % (value or "unlimited"))
+                    set_max_bandwidth(value)
+            elif key == "meta-rate":
+                if value != META_RATE:
+                    print("Max. meta requests per second: %s" % (value or "unlimited"))
+                    set_meta_rate(value)
+            else:
+                print("Unknown key in control file %r: %r, ignored" % (self.path, key))
+
+
+##################################################################################################
+# HTTP session
+#
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session():
+    # Returns the keep-alive session shared by all threads.
+    # Connections are pooled per host, a thread waits for a free connection
+    # instead of opening more than HTTP_POOL_SIZE connections to the same host.
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            pool_size = HTTP_POOL_SIZE if HTTP_POOL_SIZE > 0 else NUM_THREADS
+            if ADAPTIVE and HTTP_POOL_SIZE == 0:
+                pool_size = max(pool_size, ADAPTIVE_MAX or 128)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_HOSTS, pool_maxsize=pool_size, pool_block=True
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+        return _SESSION
+
+
+def connection_stats():
+    # Returns (requests, new connections) summed over all connection pools
+    nb_requests = 0
+    nb_connections = 0
+    if _SESSION is None:
+        return nb_requests, nb_connections
+
+    seen = set()
+    for adapter in _SESSION.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+    return nb_requests, nb_connections
+
 
 ##################################################################################################
 # functions
 #
+def parse_unit(value, units):
+    # "20G" or "90m" to a number, the unit suffix is a factor from units
+    value = value.strip()
+    factor = 1
+    if value and value[-1].lower() in units:
+        factor = units[value[-1].lower()]
+        value = value[:-1]
+    return float(value) * factor
+
+
+def set_api_endpoint(endpoint):
+    # Points the API URLs to another server, e.g. the mock server of the benchmark
+    global API_ENDPOINT, LOGIN_URL, SEQUENCES_URL, MODEL_URL
+
+    API_ENDPOINT = endpoint.rstrip("/")
+    LOGIN_URL = API_ENDPOINT + "/v2/ua/login?client_id=" + CLIENT_ID
+    SEQUENCES_URL = (
+        API_ENDPOINT
+        + "/v3/sequences?client_id="
+        + CLIENT_ID
+        + "&per_page="
+        + SEQUENCES_PER_PAGE
+    )
+    MODEL_URL = API_ENDPOINT + "/v3/model.json?client_id=" + CLIENT_ID
+
+
 def get_mpy_auth(email, password):
     # Returns mapillary token
     payload = {"email": email, "password": password}
-    r = requests.post(LOGIN_URL, json=payload)
+    _META_LIMITER.consume()
+    with _METRICS.timer("login"):
+        r = get_session().post(LOGIN_URL, json=payload, timeout=META_TIMEOUT)
     if r and "token" in r.json():
         r.close()
         return r.json()["token"]
-    elif r and "message" in r.json():
-        print("Authentication failed: %s" % r.json()["message"])
-    else:
-        print(
-            "Authentication failed with HTTP error %r : %r" % (r.status_code, r.text,)
-        )
     r.close()
-    sys.exit(-1)
+    if r and "message" in r.json():
+        raise TakeoutError("Authentication failed: %s" % r.json()["message"])
+    raise TakeoutError(
+        "Authentication failed with HTTP error %r : %r" % (r.status_code, r.text,)
+    )
 
 
-def get_user_sequences(mpy_token, username, start_date, end_date):
-    # Fetches all sequences for the username and
-    # returns them in an array of json objects
-    # https://www.mapillary.com/developer/api-documentation/#the-sequence-object
-    response = []
-    nb_images = 0
-    headers = {"Authorization": "Bearer " + mpy_token}
+class SequenceRecord:
+    # The fields of a sequence which the takeout uses. The listing keeps these
+    # instead of the features with their coordinate arrays.
+    __slots__ = ("key", "captured_at", "created_at", "camera_make", "image_keys")
 
-    try:
-        r = requests.get(
-            SEQUENCES_URL,
-            headers=headers,
-            params={"usernames": username, "start_time": start_date, "end_time": end_date},
-            timeout=META_TIMEOUT
-        )
-    except:
-        raise DownloadException("Error downloading sequence URL %r" % SEQUENCES_URL)
-
-    # validate result
-    if r.status_code != requests.codes.ok:
-        raise DownloadException("Error status response sequence URL: HTTP " + str(r.status_code) + " give up!")
-
-    try:
-        r.json()
-        r.json()["features"]
-    except:
-        raise DownloadException("Error parsing json features response, give up!")
+    def __init__(self, feature):
+        properties = feature["properties"]
+        self.key = properties["key"]
+        self.captured_at = properties["captured_at"]
+        self.created_at = properties["created_at"]
+        self.camera_make = properties.get("camera_make")
+        self.image_keys = tuple(properties["coordinateProperties"]["image_keys"])
 
 
-    for feature in r.json()["features"]:
-        response.append(feature)
-        nb_images += len(feature["properties"]["coordinateProperties"]["image_keys"])
-    r.close()
-    nb_seq = len(response)
+def iter_user_sequences(mpy_token, username, start_date, end_date, manifest=None):
+    # Yields the sequences of the username as SequenceRecord, newest first,
+    # page by page while the listing is fetched
+    # https://www.mapillary.com/developer/api-documentation/#the-sequence-object
+    #
+    # With a manifest every page is cached and indexed, and later runs only
+    # page until they reach a sequence created before the last sync (the API
+    # lists the newest sequences first). The older sequences come from the cache.
+    headers = {"Authorization": "Bearer " + mpy_token}
 
-    # first run: 100 sequences (xxx images)
-    if DEBUG >= 1:
-        print("Fetched %s sequences (%s images) ..." % (nb_seq, nb_images), end="\r")
+    high_water = None
+    if manifest is not None and not FULL_REFRESH:
+        high_water = manifest.listing_high_water(username, start_date, end_date)
+        if DEBUG >= 1 and high_water:
+            print("Fetch sequences created after %s" % high_water)
 
-    while "next" in r.links:
-        try:
-            r = requests.get(r.links["next"]["url"], headers=headers, timeout=META_TIMEOUT)
-        except:
-            print("Error downloading next URL %r" % r.links["next"]["url"])
-            continue
-    
-        if r.status_code != requests.codes.ok:
-            print("Error status response links: HTTP %d - ignore." % r.status_code)
-            continue
+    def index(feature):
+        if manifest is not None and not manifest.is_located(feature["properties"]["key"]):
+            manifest.add_locations(feature)
+        return SequenceRecord(feature)
 
+    listed = set()
+    nb_images = 0
+    newest = None
+    url = SEQUENCES_URL
+    params = {"usernames": username, "start_time": start_date, "end_time": end_date}
+    # the early stop at the high-water mark needs the newest sequences first
+    previous = None
+    ordered = True
+    synced = False
+    complete = True
+    attempts = 0
+    while url and not synced:
+        if _STOP.is_set():
+            complete = False
+            break
+        error = None
         try:
-            json = r.json()
-            features = json["features"]
+            _META_LIMITER.consume()
+            with _METRICS.timer("sequences"):
+                r = get_session().get(url, headers=headers, params=params, timeout=META_TIMEOUT)
         except:
-            print("Error parsing json object, ignore")
+            error = "Error downloading sequence URL %r" % url
+        else:
+            if r.status_code != requests.codes.ok:
+                error = "Error status response sequence URL: HTTP %d" % r.status_code
+            else:
+                try:
+                    features = r.json()["features"]
+                except:
+                    error = "Error parsing json features response"
+            r.close()
+        if error:
+            attempts += 1
+            if attempts > LISTING_RETRIES and params:
+                # nothing listed yet
+                raise DownloadException("%s, give up!" % error)
+            if attempts > LISTING_RETRIES:
+                print("%s, giving up the sequence list, the next run fetches it again" % error)
+                complete = False
+                break
+            print("%s, retry %d/%d" % (error, attempts, LISTING_RETRIES))
+            time.sleep(min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempts - 1)))
             continue
+        attempts = 0
+        url = r.links["next"]["url"] if "next" in r.links else None
+        params = None
 
+        page = []
         for feature in features:
-            response.append(feature)
-            nb_images += len(
-                feature["properties"]["coordinateProperties"]["image_keys"]
-            )
-        r.close()
-        nb_seq = len(response)
-        if DEBUG >= 1:
-            print("Fetched %s sequences (%s images) ..." % (nb_seq, nb_images), end="\r")
+            created_at = feature["properties"]["created_at"]
+            if previous and created_at > previous and ordered:
+                print("The sequence list is not sorted newest first, fetching all pages")
+                ordered = False
+                synced = False
+            previous = created_at
+            if ordered and high_water and created_at <= high_water:
+                synced = True
+                continue
+            page.append(feature)
+        if manifest is not None:
+            manifest.cache_sequences(username, page)
+        for feature in page:
+            record = index(feature)
+            listed.add(record.key)
+            nb_images += len(record.image_keys)
+            newest = max(newest or record.created_at, record.created_at)
+            yield record
+        if DEBUG >= 2:
+            print("Fetched %s sequences (%s images) ..." % (len(listed), nb_images))
 
-    # cleanup \r
     if DEBUG >= 1:
-        print("")
-    return (response, nb_seq)
+        print("Fetched %s sequences (%s images)" % (len(listed), nb_images))
+
+    if manifest is not None:
+        # only a complete listing moves the high-water mark or prunes the cache
+        if complete:
+            manifest.finish_listing(username, start_date, end_date, listed, newest, full=high_water is None)
+        if high_water:
+            nb_cached = 0
+            for feature in manifest.cached_sequences(username, start_date, end_date):
+                if feature["properties"]["key"] not in listed:
+                    nb_cached += 1
+                    yield index(feature)
+            if DEBUG >= 1:
+                print("Sequences: %d new, %d from cache" % (len(listed), nb_cached))
+
+
+def prefetch(iterable, size, idle=None):
+    # Runs an iterator in a thread and yields its items, up to size items
+    # ahead. idle() is called about once a second while the consumer waits,
+    # exceptions of the iterator are raised in the consumer. Closing the
+    # generator stops the iterator and waits for the thread.
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                put((item, None))
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = threading.Thread(target=produce, name="sequence-listing", daemon=True)
+    producer.start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=1)
+            except queue.Empty:
+                if idle:
+                    idle()
+                continue
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
 
 
 def get_source_urls(download_list, mpy_token, username):
@@ -208,7 +840,9 @@ def get_source_urls(download_list, mpy_token, username):
             counter += len(chunk)
             if DEBUG >= 3:
                 print(" Fetch model URLs in chunks: (%d/%d)" % (counter, len(download_list)))
-            r = requests.get(MODEL_URL, headers=headers, params=params, timeout=META_TIMEOUT)
+            _META_LIMITER.consume()
+            with _METRICS.timer("resolve"):
+                r = get_session().get(MODEL_URL, headers=headers, params=params, timeout=META_TIMEOUT)
         except:
             raise DownloadException("Error downloading model URL %r, ignore sequence" % MODEL_URL)
                    
@@ -229,16 +863,72 @@ def get_source_urls(download_list, mpy_token, username):
                 if "value" in image["original_url"]:
                     source_urls[image_key] = image["original_url"]["value"]
         r.close()
+        _METRICS.inc("urls_resolved", len(source_urls))
        
     return source_urls
 
 
-def download_file(args):
-    image_key, sorted_path, source_url = args
-    global _DOWNLOAD_SEQUENCE_SIZE
-    
+def part_offset(tmp_path):
+    # Returns the size of a partial download which can be resumed
+    try:
+        return os.path.getsize(tmp_path)
+    except OSError:
+        return 0
+
+
+def remove_part(tmp_path):
+    # Removes a partial download, if there is one
     try:
-        r = requests.get(source_url, stream=True, timeout=DOWNLOAD_FILE_TIMEOUT)
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def response_range(image_key, status, headers, offset):
+    # Returns (offset, total size) of a response to a request starting at
+    # offset: 206 continues the partial download, 200 starts from the beginning
+    if status == 206:
+        m = re.match(r"bytes (\d+)-\d+/(\d+)$", headers.get("content-range", ""))
+        if not m or int(m.group(1)) != offset:
+            raise DownloadException("Unexpected content range %r of %r" % (headers.get("content-range"), image_key))
+        return offset, int(m.group(2))
+    if "content-length" in headers:
+        return 0, int(headers["content-length"])
+    return 0, None
+
+
+def check_resumed(image_key, tmp_path, etag):
+    # A resumed image is compared with the MD5 ETag of the server, the parts
+    # of two versions of an image would pass the length check
+    if not etag or not re.match("^[0-9a-f]{32}$", etag.strip('"')):
+        return
+    md5 = hashlib.md5()
+    with open(tmp_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    if md5.hexdigest() != etag.strip('"'):
+        os.remove(tmp_path)
+        raise DownloadException("Checksum mismatch of resumed image %r, downloading it again" % image_key)
+
+
+def download_file(image_key, sorted_path, source_url):
+    # Downloads one image, returns the image size or False
+    # The image is streamed into a temporary file which is renamed only
+    # if it is complete, so an interrupted download never leaves a truncated jpg.
+    # The temporary file is kept after an error, the next attempt requests
+    # only the missing bytes.
+
+    if os.path.isfile(sorted_path) and os.path.getsize(sorted_path) > 0:
+        if DEBUG >= 3:
+            print("  Already downloaded as %r" % sorted_path)
+        return 0
+
+    tmp_path = sorted_path + ".part"
+    offset = part_offset(tmp_path)
+    headers = {"Range": "bytes=%d-" % offset} if offset else None
+    start = time.time()
+    try:
+        r = get_session().get(source_url, headers=headers, stream=True, timeout=DOWNLOAD_FILE_TIMEOUT)
     except requests.exceptions.SSLError:
         raise SSLException("SSL error downloading %r, retrying later" % image_key)
     except:
@@ -247,83 +937,1620 @@ def download_file(args):
         else:
             return False
             
-    if r.status_code == requests.codes.ok:
-        size = int(r.headers["content-length"])
-        if os.path.isfile(sorted_path) and os.path.getsize(sorted_path) == size:
-            if DEBUG >= 3:
-                print("  Already downloaded as %r" % sorted_path)
+    if r.status_code in (requests.codes.ok, requests.codes.partial_content):
+        written = 0
+        write_time = 0.0
+        try:
+            offset, size = response_range(image_key, r.status_code, r.headers, offset)
+            try:
+                with open(tmp_path, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                        write_start = time.time()
+                        f.write(chunk)
+                        write_time += time.time() - write_start
+                        written += len(chunk)
+                        _BANDWIDTH_LIMITER.consume(len(chunk))
+            finally:
+                # the resumed part was counted by the earlier attempt
+                _METRICS.inc("bytes_downloaded", written)
+            if size is not None and offset + written != size:
+                raise DownloadException("Incomplete download of %r: %d/%d bytes" % (image_key, offset + written, size))
+            if offset:
+                check_resumed(image_key, tmp_path, r.headers.get("etag"))
+                _METRICS.inc("images_resumed")
+            os.replace(tmp_path, sorted_path)
+            _METRICS.observe("write", write_time)
+            _METRICS.observe("download", time.time() - start)
+        except:
+            r.close()
+            if DEBUG >= 1:
+                raise DownloadException("Error downloading image %r, retrying later. Info %r" % (image_key, sys.exc_info()[1],))
+            else:
+                return False
+
+        return offset + written
+    elif r.status_code == requests.codes.range_not_satisfiable:
+        # the partial download does not match the image on the server
+        r.close()
+        remove_part(tmp_path)
+        return False
+    elif r.status_code == 403 and re.match(AWS_EXPIRED, r.text):
+        _METRICS.inc("urls_expired")
+        raise URLExpireException("Download token expired, requesting fresh one ...")
+    else:
+        print(
+            "  Error %r downloading image %r : %r" % (r.status_code, image_key, r.text,)
+        )
+    return False
+
+
+def probe_image(image_key, source_url):
+    # Returns (size, etag) of an image on the server without downloading it.
+    # Source URLs are signed for GET, so the first byte is requested instead of a HEAD.
+    try:
+        r = get_session().get(source_url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_FILE_TIMEOUT)
+    except:
+        raise DownloadException("Error probing image %r. Info %r" % (image_key, sys.exc_info()[0],))
+
+    try:
+        if r.status_code == 403 and re.match(AWS_EXPIRED, r.text):
+            _METRICS.inc("urls_expired")
+            raise URLExpireException("Download token expired, requesting fresh one ...")
+        if r.status_code == 206 and "/" in r.headers.get("content-range", ""):
+            size = int(r.headers["content-range"].rsplit("/", 1)[1])
+        elif r.status_code == requests.codes.ok and "content-length" in r.headers:
+            size = int(r.headers["content-length"])
+        else:
+            raise DownloadException("Error %r probing image %r" % (r.status_code, image_key))
+        etag = r.headers.get("etag", "").strip('"') or None
+    finally:
+        r.close()
+    return size, etag
+
+
+async def download_file_async(session, image_key, sorted_path, source_url):
+    # asyncio version of download_file() for the async engine,
+    # returns the image size or False. The file operations run in the
+    # default executor, a slow disk must not stall the event loop.
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, part_offset, sorted_path):
+        if DEBUG >= 3:
+            print("  Already downloaded as %r" % sorted_path)
+        return 0
+
+    tmp_path = sorted_path + ".part"
+    offset = await loop.run_in_executor(None, part_offset, tmp_path)
+    headers = {"Range": "bytes=%d-" % offset} if offset else None
+    start = time.time()
+    try:
+        r = await session.get(source_url, headers=headers)
+    except aiohttp.ClientSSLError:
+        raise SSLException("SSL error downloading %r, retrying later" % image_key)
+    except:
+        if DEBUG >= 1:
+            raise DownloadException("Error downloading %r, retrying later. Info %r" % (image_key, sys.exc_info()[0],) )
         else:
-            if os.path.isfile(sorted_path):
-                if DEBUG >= 2:
-                    print("  Size mismatch for %r, replacing..." % sorted_path)
+            return False
 
+    async with r:
+        if r.status in (requests.codes.ok, requests.codes.partial_content):
+            written = 0
+            write_time = 0.0
             try:
-                with open(sorted_path, "wb") as f:
-                    f.write(r.content)
+                offset, size = response_range(image_key, r.status, r.headers, offset)
+                f = await loop.run_in_executor(None, open, tmp_path, "ab" if offset else "wb")
+                try:
+                    # the chunks are collected to write ASYNC_WRITE_SIZE at once
+                    buffer = bytearray()
+                    async for chunk in r.content.iter_chunked(DOWNLOAD_BUFFER_SIZE):
+                        buffer += chunk
+                        written += len(chunk)
+                        if len(buffer) >= ASYNC_WRITE_SIZE:
+                            write_start = time.time()
+                            await loop.run_in_executor(None, f.write, buffer)
+                            write_time += time.time() - write_start
+                            buffer = bytearray()
+                        delay = _BANDWIDTH_LIMITER.reserve(len(chunk))
+                        if delay:
+                            await asyncio.sleep(delay)
+                finally:
+                    # the data received before an error is kept for the next attempt
+                    try:
+                        write_start = time.time()
+                        await loop.run_in_executor(None, f.write, buffer)
+                        write_time += time.time() - write_start
+                    finally:
+                        await loop.run_in_executor(None, f.close)
+                        # the resumed part was counted by the earlier attempt
+                        _METRICS.inc("bytes_downloaded", written)
+                if size is not None and offset + written != size:
+                    raise DownloadException("Incomplete download of %r: %d/%d bytes" % (image_key, offset + written, size))
+                if offset:
+                    await loop.run_in_executor(None, check_resumed, image_key, tmp_path, r.headers.get("etag"))
+                    _METRICS.inc("images_resumed")
+                await loop.run_in_executor(None, os.replace, tmp_path, sorted_path)
+                _METRICS.observe("write", write_time)
+                _METRICS.observe("download", time.time() - start)
             except:
                 if DEBUG >= 1:
-                     raise DownloadException("Error downloading image %r, retrying later. Info %r" % (image_key, sys.exc_info()[0],))
+                    raise DownloadException("Error downloading image %r, retrying later. Info %r" % (image_key, sys.exc_info()[1],))
                 else:
                     return False
 
-            # downloaded MB per sequence            
-            _DOWNLOAD_SEQUENCE_SIZE += size
+            return offset + written
 
-        return image_key
-    elif r.status_code == 403 and re.match(AWS_EXPIRED, r.text):
-        raise URLExpireException("Download token expired, requesting fresh one ...")
-    else:
+        if r.status == requests.codes.range_not_satisfiable:
+            # the partial download does not match the image on the server
+            await loop.run_in_executor(None, remove_part, tmp_path)
+            return False
+
+        text = await r.text(errors="replace")
+        if r.status == 403 and re.match(AWS_EXPIRED, text):
+            _METRICS.inc("urls_expired")
+            raise URLExpireException("Download token expired, requesting fresh one ...")
         print(
-            "  Error %r downloading image %r : %r" % (r.status_code, image_key, r.text,)
+            "  Error %r downloading image %r : %r" % (r.status, image_key, text,)
         )
     return False
 
 
-def download_sequence(output_folder, mpy_token, sequence, username, c, nb_sequences):
-    global _DOWNLOAD_SEQUENCE_SIZE
-    global _DOWNLOAD_TOTAL_SIZE
+##################################################################################################
+# manifest
+#
+def iso_timestamp(date):
+    # "YYYY-MM-DD" or "YYYY-MM-DDTHH:MM:SS..." in UTC to seconds since the epoch
+    if len(date) <= 10:
+        return calendar.timegm(time.strptime(date[:10], "%Y-%m-%d"))
+    return calendar.timegm(time.strptime(date[:19].replace(" ", "T"), "%Y-%m-%dT%H:%M:%S"))
+
+
+class Manifest:
+    # SQLite database in the output folder with one row per downloaded image.
+    # Resume and "already fully downloaded" decisions are indexed lookups
+    # instead of a stat() for every image of every sequence.
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_FILE)
+        self.lock = threading.Lock()
+        # image rows are written in batches, so other worker processes
+        # only wait for the manifest while a batch is written
+        self.pending = []
+
+        os.makedirs(output_folder, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=META_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=" + ("WAL" if MANIFEST_WAL else "DELETE"))
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS images (
+                image_key TEXT PRIMARY KEY,
+                sequence_key TEXT NOT NULL,
+                image_index INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                completed_at REAL NOT NULL,
+                pack_offset INTEGER
+            )"""
+        )
+        # pack_offset: offset of the image data in the tar shard at path
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(images)")]
+        if "pack_offset" not in columns:
+            self.db.execute("ALTER TABLE images ADD COLUMN pack_offset INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_sequence ON images (sequence_key)")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS sequences (
+                sequence_key TEXT PRIMARY KEY,
+                nb_images INTEGER NOT NULL,
+                completed_at REAL
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS sequence_cache (
+                sequence_key TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                captured_at TEXT NOT NULL,
+                feature TEXT NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS sequence_cache_user ON sequence_cache (username, created_at)")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS listing_syncs (
+                username TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                high_water TEXT NOT NULL,
+                PRIMARY KEY (username, start_date, end_date)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS runs (
+                started_at REAL NOT NULL,
+                duration REAL NOT NULL,
+                images INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                engine TEXT NOT NULL,
+                concurrency INTEGER NOT NULL
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS leases (
+                sequence_key TEXT PRIMARY KEY,
+                worker TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                finished_at REAL
+            )"""
+        )
+        # location index of the images: an R*Tree over lon, lat and capture
+        # time points to the rows of image_locations, the paths are taken from
+        # the images table, so they follow migrations and repairs
+        try:
+            self.db.execute(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS location_tree
+                USING rtree(id, min_lon, max_lon, min_lat, max_lat, min_time, max_time)"""
+            )
+        except sqlite3.OperationalError:
+            # SQLite without the R*Tree module, a plain table with the same columns
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS location_tree (
+                    id INTEGER PRIMARY KEY,
+                    min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL, min_time REAL, max_time REAL
+                )"""
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS location_tree_time ON location_tree (min_time)")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS image_locations (
+                id INTEGER PRIMARY KEY,
+                image_key TEXT NOT NULL UNIQUE,
+                sequence_key TEXT NOT NULL,
+                lon REAL NOT NULL,
+                lat REAL NOT NULL,
+                captured_at TEXT NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS image_locations_sequence ON image_locations (sequence_key)")
+        self.db.commit()
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.output_folder)
+
+    def abspath(self, path):
+        return os.path.join(self.output_folder, path)
+
+    def is_known(self, sequence_key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM sequences WHERE sequence_key = ?", (sequence_key,)
+            ).fetchone()
+        return row is not None
+
+    def is_complete(self, sequence_key, nb_images):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT nb_images, completed_at FROM sequences WHERE sequence_key = ?",
+                (sequence_key,),
+            ).fetchone()
+        return row is not None and row[0] == nb_images and row[1] is not None
+
+    def downloaded(self, sequence_key):
+        # Returns {image_key: (path, size, pack offset)} of the downloaded images
+        # of a sequence, the pack offset is None for unpacked images
+        with self.lock:
+            self._commit(force=True)
+            rows = self.db.execute(
+                "SELECT image_key, path, size, pack_offset FROM images WHERE sequence_key = ?",
+                (sequence_key,),
+            ).fetchall()
+        return {image_key: (self.abspath(path), size, offset) for image_key, path, size, offset in rows}
+
+    def add_sequence(self, sequence_key, nb_images):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO sequences (sequence_key, nb_images) VALUES (?, ?)",
+                (sequence_key, nb_images),
+            )
+            self.db.execute(
+                "UPDATE sequences SET nb_images = ? WHERE sequence_key = ?",
+                (nb_images, sequence_key),
+            )
+            self._commit(force=True)
+
+    def add(self, sequence_key, image_key, image_index, path, size, offset=None):
+        with self.lock:
+            self.pending.append(
+                (image_key, sequence_key, image_index, self.relpath(path), size, time.time(), offset)
+            )
+            self._commit()
+
+    def remove(self, image_keys):
+        with self.lock:
+            self._commit(force=True)
+            self.db.executemany(
+                "DELETE FROM images WHERE image_key = ?", [(k,) for k in image_keys]
+            )
+            self._commit(force=True)
+
+    def set_complete(self, sequence_key, complete):
+        with self.lock:
+            self.db.execute(
+                "UPDATE sequences SET completed_at = ? WHERE sequence_key = ?",
+                (time.time() if complete else None, sequence_key),
+            )
+            self._commit(force=True)
+
+    def listing_high_water(self, username, start_date, end_date):
+        # Returns the newest created_at of the last sync which covers the date range
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT start_date, end_date, high_water FROM listing_syncs WHERE username = ?",
+                (username,),
+            ).fetchall()
+        high_water = None
+        for sync_start, sync_end, sync_high_water in rows:
+            if sync_start and (not start_date or start_date < sync_start):
+                continue
+            if sync_end and (not end_date or end_date > sync_end):
+                continue
+            if high_water is None or sync_high_water < high_water:
+                high_water = sync_high_water
+        return high_water
+
+    def cached_sequences(self, username, start_date, end_date):
+        # Yields the cached sequence features in the date range, newest first.
+        # The rows are read in batches, no statement stays open between them.
+        query = "SELECT feature, created_at, sequence_key FROM sequence_cache WHERE username = ?"
+        params = [username]
+        if start_date:
+            query += " AND captured_at >= ?"
+            params.append(start_date)
+        if end_date:
+            query += " AND captured_at < ?"
+            params.append(end_date)
+        last = None
+        while True:
+            with self.lock:
+                if last:
+                    rows = self.db.execute(
+                        query + " AND (created_at, sequence_key) < (?, ?) ORDER BY created_at DESC, sequence_key DESC LIMIT 100",
+                        params + list(last),
+                    ).fetchall()
+                else:
+                    rows = self.db.execute(query + " ORDER BY created_at DESC, sequence_key DESC LIMIT 100", params).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[0])
+            last = rows[-1][1:]
+
+    def cache_sequences(self, username, features):
+        # Caches a page of fetched sequence features
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sequence_cache VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        feature["properties"]["key"],
+                        username,
+                        feature["properties"]["created_at"],
+                        feature["properties"]["captured_at"],
+                        json.dumps(feature, separators=(",", ":")),
+                    )
+                    for feature in features
+                ],
+            )
+            self._commit(force=True)
+
+    def finish_listing(self, username, start_date, end_date, listed, high_water, full):
+        # Moves the high-water mark to the newest listed sequence once a listing
+        # is complete. A full listing drops the cached sequences of the date
+        # range which are not listed anymore.
+        with self.lock:
+            self._commit(force=True)
+            # read and update the high-water mark in one write transaction,
+            # other workers may sync the same listing at the same time
+            self.db.execute("BEGIN IMMEDIATE")
+            if full:
+                query = "SELECT sequence_key FROM sequence_cache WHERE username = ?"
+                params = [username]
+                if start_date:
+                    query += " AND captured_at >= ?"
+                    params.append(start_date)
+                if end_date:
+                    query += " AND captured_at < ?"
+                    params.append(end_date)
+                gone = [row for row in self.db.execute(query, params).fetchall() if row[0] not in listed]
+                self.db.executemany("DELETE FROM sequence_cache WHERE sequence_key = ?", gone)
+
+            row = self.db.execute(
+                "SELECT high_water FROM listing_syncs WHERE username = ? AND start_date = ? AND end_date = ?",
+                (username, start_date or "", end_date or ""),
+            ).fetchone()
+            if row and not full and (high_water is None or row[0] > high_water):
+                high_water = row[0]
+            if high_water is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO listing_syncs VALUES (?, ?, ?, ?)",
+                    (username, start_date or "", end_date or "", high_water),
+                )
+            self._commit(force=True)
+
+    def move(self, moves):
+        # updates the paths of moved images, moves are (old path, new path).
+        # The rows are updated by image key, path has no index.
+        with self.lock:
+            self._commit(force=True)
+            image_keys = dict((path, image_key) for image_key, path in self.db.execute("SELECT image_key, path FROM images"))
+            updates = []
+            for old, new in moves:
+                image_key = image_keys.get(self.relpath(old))
+                if image_key is not None:
+                    updates.append((self.relpath(new), image_key))
+            self.db.executemany("UPDATE images SET path = ? WHERE image_key = ?", updates)
+            self._commit(force=True)
+
+    def sequence_sizes(self):
+        # Returns {sequence_key: (downloaded images, bytes)}
+        with self.lock:
+            self._commit(force=True)
+            rows = self.db.execute(
+                "SELECT sequence_key, COUNT(*), SUM(size) FROM images GROUP BY sequence_key"
+            ).fetchall()
+        return {sequence_key: (nb_images, nb_bytes) for sequence_key, nb_images, nb_bytes in rows}
+
+    def average_image_size(self):
+        with self.lock:
+            self._commit(force=True)
+            row = self.db.execute("SELECT AVG(size) FROM images WHERE size > 0").fetchone()
+        return row[0]
+
+    def add_run(self, started_at, duration, images, nb_bytes, engine, concurrency):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                (started_at, duration, images, nb_bytes, engine, concurrency),
+            )
+            self._commit(force=True)
+
+    def throughput(self, nb_runs):
+        # Returns the download rate in bytes/sec. of the last runs, or None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT duration, bytes FROM runs WHERE bytes > 0 ORDER BY started_at DESC LIMIT ?",
+                (nb_runs,),
+            ).fetchall()
+        duration = sum(row[0] for row in rows)
+        if not duration:
+            return None
+        return sum(row[1] for row in rows) / duration
+
+    def claim_lease(self, sequence_key, worker, ttl, since):
+        # Takes the lease of a sequence unless another worker holds a valid
+        # lease or the sequence was finished by any worker after since.
+        # Every statement is atomic, so at most one worker gets the lease.
+        now = time.time()
+        with self.lock:
+            self._commit(force=True)
+            claimed = self.db.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?, ?, NULL)",
+                (sequence_key, worker, now + ttl),
+            ).rowcount
+            if not claimed:
+                claimed = self.db.execute(
+                    """UPDATE leases SET worker = ?, expires_at = ?, finished_at = NULL
+                    WHERE sequence_key = ? AND (worker = ? OR expires_at < ?)
+                    AND (finished_at IS NULL OR finished_at < ?)""",
+                    (worker, now + ttl, sequence_key, worker, now, since),
+                ).rowcount
+            self.db.commit()
+        return claimed == 1
+
+    def renew_leases(self, sequence_keys, worker, ttl):
+        # Returns the number of leases which are still held by the worker
+        with self.lock:
+            self._commit(force=True)
+            renewed = self.db.executemany(
+                "UPDATE leases SET expires_at = ? WHERE sequence_key = ? AND worker = ? AND finished_at IS NULL",
+                [(time.time() + ttl, sequence_key, worker) for sequence_key in sequence_keys],
+            ).rowcount
+            self.db.commit()
+        return renewed
+
+    def release_lease(self, sequence_key, worker):
+        with self.lock:
+            self._commit(force=True)
+            self.db.execute(
+                "UPDATE leases SET expires_at = 0, finished_at = ? WHERE sequence_key = ? AND worker = ?",
+                (time.time(), sequence_key, worker),
+            )
+            self.db.commit()
+
+    def lease_finished(self, sequence_key, since):
+        # True if a worker finished the sequence after since
+        with self.lock:
+            row = self.db.execute(
+                "SELECT finished_at FROM leases WHERE sequence_key = ?", (sequence_key,)
+            ).fetchone()
+        return row is not None and row[0] is not None and row[0] >= since
+
+    def is_located(self, sequence_key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM image_locations WHERE sequence_key = ? LIMIT 1", (sequence_key,)
+            ).fetchone()
+        return row is not None
+
+    def add_locations(self, feature):
+        # Indexes the location and capture time of the images of a sequence feature.
+        # API v3 has one capture time per sequence, all images get it.
+        sequence_key = feature["properties"]["key"]
+        captured_at = feature["properties"]["captured_at"]
+        timestamp = iso_timestamp(captured_at)
+        image_keys = feature["properties"]["coordinateProperties"]["image_keys"]
+        coordinates = feature["geometry"]["coordinates"]
+        with self.lock:
+            self._commit(force=True)
+            self.db.execute(
+                "DELETE FROM location_tree WHERE id IN (SELECT id FROM image_locations WHERE sequence_key = ?)",
+                (sequence_key,),
+            )
+            self.db.execute("DELETE FROM image_locations WHERE sequence_key = ?", (sequence_key,))
+            for image_key, (lon, lat) in zip(image_keys, (c[:2] for c in coordinates)):
+                row_id = self.db.execute(
+                    "INSERT OR REPLACE INTO image_locations (image_key, sequence_key, lon, lat, captured_at) VALUES (?, ?, ?, ?, ?)",
+                    (image_key, sequence_key, lon, lat, captured_at),
+                ).lastrowid
+                self.db.execute(
+                    "INSERT INTO location_tree VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (row_id, lon, lon, lat, lat, timestamp, timestamp),
+                )
+            self.db.commit()
+
+    def query_locations(self, bbox=None, start_date=None, end_date=None, sequence_key=None):
+        # Returns (image key, sequence key, captured_at, lon, lat, path, pack offset, size)
+        # of the downloaded images in the bounding box (min lon, min lat, max lon, max lat)
+        # and date range. The tree stores 32 bit floats, its bounds are widened
+        # and the exact values are compared afterwards.
+        query = """SELECT l.image_key, l.sequence_key, l.captured_at, l.lon, l.lat, i.path, i.pack_offset, i.size
+            FROM location_tree t
+            JOIN image_locations l ON l.id = t.id
+            JOIN images i ON i.image_key = l.image_key
+            WHERE 1"""
+        params = []
+        if bbox:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            query += """ AND t.max_lon >= ? AND t.min_lon <= ? AND t.max_lat >= ? AND t.min_lat <= ?
+                AND l.lon BETWEEN ? AND ? AND l.lat BETWEEN ? AND ?"""
+            params += [min_lon - 1e-4, max_lon + 1e-4, min_lat - 1e-4, max_lat + 1e-4, min_lon, max_lon, min_lat, max_lat]
+        if start_date:
+            query += " AND t.max_time >= ? AND l.captured_at >= ?"
+            params += [iso_timestamp(start_date) - 3600, start_date]
+        if end_date:
+            query += " AND t.min_time < ? AND l.captured_at < ?"
+            params += [iso_timestamp(end_date) + 3600, end_date]
+        if sequence_key:
+            query += " AND l.sequence_key = ?"
+            params.append(sequence_key)
+        query += " ORDER BY l.captured_at, l.sequence_key, i.image_index"
+        with self.lock:
+            self._commit(force=True)
+            rows = self.db.execute(query, params).fetchall()
+        return [row[:5] + (self.abspath(row[5]),) + row[6:] for row in rows]
+
+    def _commit(self, force=False):
+        # batch inserts, the caller holds the lock
+        if force or len(self.pending) >= MANIFEST_COMMIT_INTERVAL:
+            if self.pending:
+                self.db.executemany(
+                    """INSERT OR REPLACE INTO images
+                    (image_key, sequence_key, image_index, path, size, completed_at, pack_offset)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    self.pending,
+                )
+                self.pending = []
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self._commit(force=True)
+            self.db.close()
+
+
+class PackedOutput:
+    # Appends the downloaded images to size-capped tar shards per day or per
+    # sequence. Every shard has a sidecar index "<shard>.idx" with one line per
+    # image: image key, sequence key, image index, offset and size of the
+    # image data, so an image is read without scanning the shard. The member
+    # names are the paths of the unpacked layout, tar xf in the output folder
+    # unpacks a shard. Data after the last indexed image, e.g. of a crash, is
+    # cut off when the shard is opened again.
+
+    def __init__(self, output_folder, pack_by, max_size, suffix=""):
+        # sharded workers append to their own shards, marked by the suffix
+        self.output_folder = output_folder
+        self.pack_by = pack_by
+        self.max_size = max_size
+        self.suffix = suffix
+        # guards the shards and their space, the data is copied under the
+        # lock of the shard, so images of different shards are copied in parallel
+        self.lock = threading.Lock()
+        self.shards = {}  # (folder, prefix): open PackShard
+
+    def add(self, seq, image_key, sorted_path, size):
+        # Moves a downloaded image into its shard, returns (shard path, offset)
+        day = seq.sequence_name.split("T")[0]
+        folder = os.path.join(self.output_folder, day)
+        prefix = (day if self.pack_by == "day" else seq.sequence_name) + self.suffix
+        info = tarfile.TarInfo(os.path.relpath(sorted_path, self.output_folder))
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.GNU_FORMAT)
+        member_size = len(header) + size + -size % tarfile.BLOCKSIZE
+
+        with self.lock:
+            shard = self._shard(folder, prefix, member_size)
+            shard.reserved += member_size
+            shard.pending += 1
+        try:
+            with shard.lock:
+                # a failed copy leaves data after the end, it is overwritten
+                shard.file.seek(shard.end)
+                offset = shard.end + len(header)
+                shard.file.write(header)
+                with open(sorted_path, "rb") as f:
+                    shutil.copyfileobj(f, shard.file, DOWNLOAD_BUFFER_SIZE)
+                shard.file.write(bytes(-size % tarfile.BLOCKSIZE))
+                shard.file.flush()
+                shard.index.write("%s\t%s\t%d\t%d\t%d\n" % (
+                    image_key, seq.sequence_key, seq.image_indexes[image_key], offset, size))
+                shard.index.flush()
+                shard.end = offset + size + -size % tarfile.BLOCKSIZE
+        finally:
+            with self.lock:
+                shard.pending -= 1
+                if shard.retired and not shard.pending:
+                    shard.close()
+        os.remove(sorted_path)
+        return shard.path, offset
+
+    def finish(self, seq):
+        # removes the folder of the sequence if all its images are in the shards
+        for folder in {os.path.dirname(path) for path in seq.image_paths.values()}:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+
+    def _shard(self, folder, prefix, size):
+        # Returns the open shard of the prefix with room for size bytes
+        shard = self.shards.get((folder, prefix))
+        if shard and shard.reserved and shard.reserved + size > self.max_size:
+            self._retire(shard)
+            shard = PackShard(shard.folder, prefix, shard.number + 1)
+            self.shards[(folder, prefix)] = shard
+        elif shard is None:
+            # continue with the last shard of an earlier run
+            number = 1
+            pattern = re.compile(re.escape(prefix) + r"_(\d+)\.tar$")
+            os.makedirs(folder, exist_ok=True)
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    m = pattern.match(entry.name)
+                    if m:
+                        number = max(number, int(m.group(1)))
+            shard = PackShard(folder, prefix, number)
+            if shard.end and shard.end + size > self.max_size:
+                shard.close()
+                shard = PackShard(folder, prefix, number + 1)
+            self.shards[(folder, prefix)] = shard
+        return shard
+
+    def _retire(self, shard):
+        # a full shard is closed once the copies into it are done
+        if shard.pending:
+            shard.retired = True
+        else:
+            shard.close()
+
+    def close(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards = {}
+
+
+class PackShard:
+    # One open tar shard and its sidecar index
+
+    def __init__(self, folder, prefix, number):
+        self.folder = folder
+        self.number = number
+        self.path = os.path.join(folder, "%s_%04d.tar" % (prefix, number))
+        self.lock = threading.Lock()
+        # copies which have reserved space in the shard, by PackedOutput
+        self.reserved = 0
+        self.pending = 0
+        self.retired = False
+        self.end = 0
+        try:
+            with open(self.path + ".idx") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 5:
+                        offset, size = int(fields[3]), int(fields[4])
+                        self.end = offset + size + -size % tarfile.BLOCKSIZE
+        except FileNotFoundError:
+            pass
+        self.file = open(self.path, "r+b" if os.path.exists(self.path) else "w+b")
+        self.file.truncate(self.end)
+        self.file.seek(self.end)
+        self.reserved = self.end
+        self.index = open(self.path + ".idx", "a")
+
+    def close(self):
+        # end of archive marker, cut off again when the shard is continued
+        self.file.seek(self.end)
+        self.file.write(bytes(2 * tarfile.BLOCKSIZE))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.index.close()
+
+
+class SequenceLeases:
+    # Sequence leases of this worker in the shared manifest. Leases are
+    # renewed while their sequences download; the lease of a crashed worker
+    # expires after LEASE_TTL seconds and another worker takes it over.
+
+    def __init__(self, manifest, worker_id):
+        self.manifest = manifest
+        self.worker_id = worker_id
+        self.started = time.time()
+        self.held = set()
+        self.next_renew = time.time() + LEASE_TTL / 3
+
+    def claim(self, sequence_key):
+        if not self.manifest.claim_lease(sequence_key, self.worker_id, LEASE_TTL, self.started):
+            return False
+        self.held.add(sequence_key)
+        _METRICS.inc("leases_claimed")
+        return True
+
+    def release(self, sequence_key):
+        if sequence_key in self.held:
+            self.held.discard(sequence_key)
+            self.manifest.release_lease(sequence_key, self.worker_id)
+
+    def finished(self, sequence_key):
+        # True if any worker finished the sequence during this run
+        return self.manifest.lease_finished(sequence_key, self.started)
+
+    def abandon(self):
+        # lets the leases of unfinished sequences expire now, other workers take them over
+        if self.held:
+            self.manifest.renew_leases(self.held, self.worker_id, 0)
+            self.held = set()
+
+    def poll(self):
+        if time.time() < self.next_renew:
+            return
+        self.next_renew = time.time() + LEASE_TTL / 3
+        if not self.held:
+            return
+        renewed = self.manifest.renew_leases(self.held, self.worker_id, LEASE_TTL)
+        if renewed < len(self.held):
+            print(" Lost %d/%d sequence leases to other workers" % (len(self.held) - renewed, len(self.held)))
+
+
+##################################################################################################
+# concurrency control
+#
+class AdaptiveConcurrency:
+    # AIMD controller for the number of active download workers.
+    # The engine starts the maximum number of workers, a worker has to
+    # acquire a slot before it takes the next image. Every ADAPTIVE_INTERVAL
+    # seconds the observed error, timeout, latency and throughput figures
+    # grow the limit by one step or cut it by ADAPTIVE_DECREASE.
+
+    def __init__(self, minimum, maximum, initial):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.active = 0
+        self.cond = threading.Condition()
+        # called after a slot was released or the limit changed
+        self.on_change = None
+
+        self.best_latency = None
+        self.last_throughput = None
+        self.increased = False
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.samples = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.latency = 0.0
+        self.bytes = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        with self.cond:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+        if self.on_change:
+            self.on_change()
+
+    def free(self):
+        with self.cond:
+            return self.limit - self.active
+
+    def record(self, elapsed, size, failed, backlog):
+        # called by the workers after each image
+        changed = False
+        with self.cond:
+            self.samples += 1
+            self.latency += elapsed
+            if failed:
+                self.failures += 1
+                if elapsed >= DOWNLOAD_FILE_TIMEOUT * 0.9:
+                    self.timeouts += 1
+            elif size:
+                self.bytes += size
+
+            now = time.time()
+            if now - self.window_start >= ADAPTIVE_INTERVAL and self.samples >= ADAPTIVE_MIN_SAMPLES:
+                changed = self._adjust(now, backlog)
+        if changed and self.on_change:
+            self.on_change()
+
+    def _adjust(self, now, backlog):
+        # the caller holds the lock, returns True if the limit changed
+        error_rate = self.failures / self.samples
+        timeout_rate = self.timeouts / self.samples
+        latency = self.latency / self.samples
+        throughput = self.bytes / (now - self.window_start)
+
+        old_limit = self.limit
+        if timeout_rate > ADAPTIVE_MAX_TIMEOUT_RATE or error_rate > ADAPTIVE_MAX_ERROR_RATE:
+            # multiplicative decrease
+            self.limit = max(self.minimum, int(self.limit * ADAPTIVE_DECREASE))
+            reason = "errors"
+        elif self.increased and self.last_throughput and throughput < self.last_throughput * 0.9:
+            # the last increase did not pay off, step back
+            self.limit = max(self.minimum, self.limit - ADAPTIVE_STEP)
+            reason = "throughput dropped"
+        elif backlog > 0 and (self.best_latency is None or latency <= self.best_latency * ADAPTIVE_LATENCY_FACTOR):
+            # additive increase while there is work waiting
+            self.limit = min(self.maximum, self.limit + ADAPTIVE_STEP)
+            reason = "increase"
+        else:
+            reason = "hold"
 
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        self.increased = self.limit > old_limit
+        self.last_throughput = throughput
+
+        if self.limit != old_limit:
+            print(
+                "Concurrency %d -> %d (%s): errors %2.1f%%, timeouts %2.1f%%, latency %2.2f sec., %2.1f MB/s"
+                % (old_limit, self.limit, reason, error_rate * 100, timeout_rate * 100, latency, throughput / 1024 / 1024),
+                flush=True,
+            )
+            _METRICS.event("concurrency", old=old_limit, new=self.limit, reason=reason,
+                           error_rate=error_rate, timeout_rate=timeout_rate, latency=latency,
+                           throughput=throughput)
+            self.cond.notify_all()
+        self._reset_window(now)
+        return self.limit != old_limit
+
+
+##################################################################################################
+# source URL cache
+#
+def url_expiry(source_url):
+    # Returns the expiry time of a signed URL as unix time, or None
+    params = urllib.parse.parse_qs(urllib.parse.urlparse(source_url).query)
+    try:
+        if "X-Amz-Date" in params and "X-Amz-Expires" in params:
+            signed = calendar.timegm(time.strptime(params["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ"))
+            return signed + int(params["X-Amz-Expires"][0])
+        if "Expires" in params:
+            return int(params["Expires"][0])
+    except ValueError:
+        pass
+    return None
+
+
+class SourceURLCache:
+    # Signed source URLs of the images still to download, with the time
+    # they were obtained and their expiry. URLs close to their expiry are
+    # handed out by expiring() to be refreshed in the background, before
+    # a download runs into the "Request has expired" 403.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # image_key: [source_url, obtained, refresh_at, seq, refreshing]
+        self.entries = {}
+
+    def put(self, seq, source_urls):
+        now = time.time()
+        with self.lock:
+            for image_key, source_url in source_urls.items():
+                expires = url_expiry(source_url)
+                refresh_at = None
+                # an URL which looks expired on arrival means a skewed clock,
+                # rely on the 403 response for it
+                if expires is not None and expires > now:
+                    refresh_at = expires - min(URL_REFRESH_MARGIN, (expires - now) / 4)
+                self.entries[image_key] = [source_url, now, refresh_at, seq, False]
+
+    def get(self, image_key):
+        # Returns the URL if it is known and not due for a refresh
+        with self.lock:
+            entry = self.entries.get(image_key)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] <= time.time():
+            return None
+        return entry[0]
+
+    def drop(self, image_key):
+        with self.lock:
+            self.entries.pop(image_key, None)
+
+    def expiring(self):
+        # Returns {seq: [image_key, ...]} of the URLs due for a refresh,
+        # each URL is handed out only once until it is put() again
+        now = time.time()
+        expiring = {}
+        with self.lock:
+            for image_key, entry in self.entries.items():
+                if entry[2] is not None and entry[2] <= now and not entry[4]:
+                    entry[4] = True
+                    expiring.setdefault(entry[3], []).append(image_key)
+        return expiring
+
+    def refresh_failed(self, image_keys):
+        with self.lock:
+            for image_key in image_keys:
+                entry = self.entries.get(image_key)
+                if entry is not None:
+                    entry[4] = False
+
+
+##################################################################################################
+# download engine
+#
+class SequenceDownload:
+    # State of one sequence inside the download engine: the images still to
+    # download, the attempts per image and the downloaded size.
+    # Updated by the workers, the resolver and the scheduler under the engine lock.
+
+    def __init__(self, sequence, sequence_name, image_paths, download_list, mpy_token, username, c, nb_sequences):
+        self.sequence = sequence
+        self.sequence_key = sequence.key
+        self.sequence_name = sequence_name
+        self.image_paths = image_paths
+        self.image_indexes = {image_key: i for i, image_key in enumerate(image_paths, 1)}
+        self.download_list = set(download_list)
+        self.mpy_token = mpy_token
+        self.username = username
+        self.c = c
+        self.nb_sequences = nb_sequences
+
+        self.total = len(self.download_list)
+        self.done = 0
+        self.size = 0
+        self.attempts = {}
+        self.failed = set()
+
+        # image keys to resolve with the next model request, and the
+        # image keys which are queued for download once they have a URL
+        self.url_wanted = set()
+        self.url_waiting = set()
+        self.url_flush_scheduled = False
+
+
+class DownloadEngine:
+    # One long-lived set of worker threads fed by a global job queue.
+    # Images of all sequences are streamed through the same workers, so the
+    # link stays busy while the next sequence is prepared.
+    #
+    # Every image is retried on its own: a failed image is put back into the
+    # queue after an exponential backoff, an expired URL only refreshes the
+    # URL of this image. Source URLs are looked up in the URL cache when a
+    # worker takes the image, the scheduler refreshes URLs which are about
+    # to expire in the background. "Done sequence" is reported by the thread which
+    # calls run_pending() once the last image of a sequence is finished.
+
+    def __init__(self, num_threads, manifest, controller=None):
+        from multiprocessing.pool import ThreadPool
+
+        # with a controller num_threads is the maximum of active workers
+        self.concurrency = num_threads
+        self.controller = controller
+        self.manifest = manifest
+        self.resolver = ThreadPool(URL_THREADS)
+        self.urls = SourceURLCache()
+        self.jobs = queue.Queue()
+        self.finished = queue.Queue()
+        self.lock = threading.Lock()
+        self.active = 0
+        # submitted sequences which are not finished yet
+        self.sequences = set()
+        # called with every finished SequenceDownload
+        self.on_finish = None
+        # PackedOutput which takes the downloaded images
+        self.packer = None
+
+        # retries waiting for their backoff deadline: (deadline, n, seq, image_key)
+        self.delayed = []
+        self.delayed_count = 0
+        self.delayed_cond = threading.Condition()
+        self.stopping = False
+        # set by cancel(), queued images are dropped
+        self.cancelled = False
+        # cancels the download once this many bytes are downloaded, 0: unlimited
+        self.max_bytes = 0
+        self.scheduler = threading.Thread(target=self._scheduler, name="download-scheduler", daemon=True)
+        self.scheduler.start()
+
+        self.workers = []
+        self._start_workers(num_threads)
+
+    def _start_workers(self, num_threads):
+        for i in range(num_threads):
+            worker = threading.Thread(target=self._worker, name="download-%d" % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _worker(self):
+        while True:
+            if self.controller:
+                self.controller.acquire()
+            job = self.jobs.get()
+            if job is None or self.cancelled:
+                if self.controller:
+                    self.controller.release()
+                if job is None:
+                    return
+                continue
+            seq, image_key, sorted_path = job
+            source_url = self._job_url(seq, image_key)
+            if source_url is None:
+                if self.controller:
+                    self.controller.release()
+                continue
+
+            size = False
+            expired = False
+            start = time.time()
+            try:
+                size = download_file(image_key, sorted_path, source_url)
+            except URLExpireException as e:
+                if DEBUG >= 1:
+                    print(e)
+                expired = True
+            except (SSLException, DownloadException) as e:
+                print(e)
+            except:
+                print("Unexpected error downloading %r: %r" % (image_key, sys.exc_info()[1]))
+
+            if self.controller:
+                self.controller.release()
+                self.controller.record(time.time() - start, size, size is False and not expired, self.backlog())
+            self._job_done(seq, image_key, sorted_path, size, expired)
+
+    def _job_url(self, seq, image_key):
+        # Returns the source URL for a queued image. Without a valid URL
+        # the image waits for the resolver and is queued again.
+        source_url = self.urls.get(image_key)
+        if source_url is None:
+            self._request_urls(seq, [image_key], URL_REFRESH_DELAY)
+        return source_url
+
+    def _job_done(self, seq, image_key, sorted_path, size, expired):
+        # records a finished download attempt of one image
+        if expired:
+            # not counted as attempt, only this URL is refreshed
+            self.urls.drop(image_key)
+            self._request_urls(seq, [image_key], URL_REFRESH_DELAY)
+            return
+
+        if size is False:
+            self._retry(seq, image_key)
+            return
+
+        path = sorted_path
+        file_size = size if size else os.path.getsize(sorted_path)
+        offset = None
+        if self.packer:
+            try:
+                path, offset = self.packer.add(seq, image_key, sorted_path, file_size)
+            except OSError as e:
+                print(" Error packing image %r: %s" % (image_key, e))
+                self._retry(seq, image_key)
+                return
+        self.manifest.add(
+            seq.sequence_key,
+            image_key,
+            seq.image_indexes[image_key],
+            path,
+            file_size,
+            offset,
+        )
+        if size:
+            _METRICS.inc("images_downloaded")
+            if self.max_bytes and _METRICS.get("bytes_downloaded") >= self.max_bytes and not self.cancelled:
+                print("Reached the max. bytes, stopping the download")
+                self.cancel()
+        else:
+            _METRICS.inc("images_skipped")
+        with self.lock:
+            seq.download_list.discard(image_key)
+            seq.done += 1
+            seq.size += size
+            done, total = seq.done, seq.total
+            finished = not seq.download_list
+        # after the discard, a late refresh of the URL is not cached again
+        self.urls.drop(image_key)
+        print(
+            "  Downloading images #%03d out of %03d" % (done, total),
+            end="\r",
+            flush=True,
+        )
+        _METRICS.notify("image_done", sequence=seq.sequence_key, image=image_key, bytes=size, done=done, total=total)
+        if finished:
+            self.finished.put(seq)
+
+    def _retry(self, seq, image_key, need_url=False):
+        # schedules the next attempt of an image after an exponential backoff
+        with self.lock:
+            attempts = seq.attempts.get(image_key, 0) + 1
+            seq.attempts[image_key] = attempts
+            if attempts >= IMAGE_DL_MAX_RETRIES:
+                seq.download_list.discard(image_key)
+                seq.failed.add(image_key)
+                finished = not seq.download_list
+        if attempts >= IMAGE_DL_MAX_RETRIES or need_url:
+            self.urls.drop(image_key)
+        if attempts >= IMAGE_DL_MAX_RETRIES:
+            print(" Giving up image %r after %d attempts" % (image_key, attempts))
+            remove_part(seq.image_paths[image_key] + ".part")
+            _METRICS.inc("images_failed")
+            _METRICS.event("image_failed", sequence=seq.sequence_key, image=image_key, attempts=attempts)
+            if finished:
+                self.finished.put(seq)
+            return
+
+        _METRICS.inc("retries")
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        if DEBUG >= 2:
+            print(" Retry %d/%d of image %r in %2.1f sec." % (attempts, IMAGE_DL_MAX_RETRIES, image_key, delay))
+        self._schedule(time.time() + delay, seq, image_key)
+
+    def _schedule(self, deadline, seq, image_key):
+        # image_key None flushes the URL requests of the sequence
+        with self.delayed_cond:
+            self.delayed_count += 1
+            heapq.heappush(self.delayed, (deadline, self.delayed_count, seq, image_key))
+            self.delayed_cond.notify()
+
+    def _scheduler(self):
+        # Moves retries whose backoff is over into the job queue and
+        # refreshes source URLs which are about to expire
+        next_check = time.time() + URL_REFRESH_CHECK
+        while True:
+            with self.delayed_cond:
+                while not self.stopping:
+                    now = time.time()
+                    if now >= next_check or (self.delayed and self.delayed[0][0] <= now):
+                        break
+                    deadline = next_check
+                    if self.delayed:
+                        deadline = min(deadline, self.delayed[0][0])
+                    self.delayed_cond.wait(deadline - now)
+                if self.stopping:
+                    return
+                item = None
+                if self.delayed and self.delayed[0][0] <= time.time():
+                    item = heapq.heappop(self.delayed)
+
+            if time.time() >= next_check:
+                next_check = time.time() + URL_REFRESH_CHECK
+                for seq, image_keys in self.urls.expiring().items():
+                    _METRICS.inc("urls_refreshed", len(image_keys))
+                    if DEBUG >= 2:
+                        print(" Refresh %d source URLs of %r before they expire" % (len(image_keys), seq.sequence_name))
+                    self._request_urls(seq, image_keys, waiting=False)
+
+            if item is None:
+                continue
+            deadline, n, seq, image_key = item
+            if image_key is None:
+                self._flush_urls(seq)
+            else:
+                self._put_job((seq, image_key, seq.image_paths[image_key]))
+
+    def _request_urls(self, seq, image_keys, delay=0, waiting=True):
+        # Queues image keys for URL resolution. Requests within delay
+        # seconds are collected, so the model is asked in full chunks.
+        # Waiting images are queued for download once they are resolved,
+        # the others only get a fresh URL in the cache.
+        with self.lock:
+            seq.url_wanted.update(image_keys)
+            if waiting:
+                seq.url_waiting.update(image_keys)
+            if seq.url_flush_scheduled:
+                return
+            seq.url_flush_scheduled = True
+        if delay:
+            self._schedule(time.time() + delay, seq, None)
+        else:
+            self._flush_urls(seq)
+
+    def _flush_urls(self, seq):
+        with self.lock:
+            download_list = sorted(seq.url_wanted, key=seq.image_indexes.get)
+            seq.url_wanted = set()
+            seq.url_flush_scheduled = False
+        chunks = [
+            download_list[x : x + REQUESTS_PER_CALL]
+            for x in range(0, len(download_list), REQUESTS_PER_CALL)
+        ]
+        for chunk in chunks:
+            self.resolver.apply_async(self._resolve_chunk, (seq, chunk))
+
+    def _resolve_chunk(self, seq, chunk):
+        # Runs in the resolver pool, one model request per chunk.
+        # Resolved images are queued for download right away.
+        if self.cancelled:
+            return
+        try:
+            source_urls = get_source_urls(chunk, seq.mpy_token, seq.username)
+        except DownloadException as e:
+            print(e)
+            source_urls = {}
+        except:
+            print("Unexpected error resolving source URLs: %r" % (sys.exc_info()[1],))
+            source_urls = {}
+        if self.cancelled:
+            return
+
+        with self.lock:
+            # a refresh may arrive after the image is done
+            self.urls.put(seq, {k: v for k, v in source_urls.items() if k in seq.download_list})
+            ready = [k for k in chunk if k in source_urls and k in seq.url_waiting]
+            missing = [k for k in chunk if k not in source_urls and k in seq.url_waiting]
+            seq.url_waiting.difference_update(ready)
+            seq.url_waiting.difference_update(missing)
+        # a failed background refresh is tried again on the next check
+        self.urls.refresh_failed([k for k in chunk if k not in source_urls])
+        for image_key in ready:
+            self._put_job((seq, image_key, seq.image_paths[image_key]))
+        if missing:
+            print(
+                " Missing %d/%d images, will refresh and retry later"
+                % (len(missing), len(chunk))
+            )
+            for image_key in missing:
+                self._retry(seq, image_key, need_url=True)
+
+    def _put_job(self, job):
+        self.jobs.put(job)
+
+    def backlog(self):
+        # number of queued images, used to prepare the next sequence in time
+        return self.jobs.qsize() + self._resolving()
+
+    def _resolving(self):
+        # number of images which wait for their source URL
+        with self.lock:
+            return sum(len(seq.url_waiting) for seq in self.sequences)
+
+    def submit(self, seq):
+        self.active += 1
+        with self.lock:
+            self.sequences.add(seq)
+        self._request_urls(seq, seq.image_paths.keys() & seq.download_list)
+        if DEBUG >= 3:
+            print(" Filling download queue done")
+
+    def _finish(self, seq):
+        self.active -= 1
+        with self.lock:
+            self.sequences.discard(seq)
+        _METRICS.inc("sequences_done")
+        _METRICS.event("sequence_done", sequence=seq.sequence_key, name=seq.sequence_name,
+                       images=seq.done, failed=len(seq.failed), bytes=seq.size)
+        self.manifest.set_complete(seq.sequence_key, not seq.failed)
+        if self.packer:
+            self.packer.finish(seq)
+        if self.on_finish:
+            self.on_finish(seq)
+        print(" Done sequence %r (%d/%s) %3.1f MB, camera: %s" % (seq.sequence_name, seq.c, seq.nb_sequences or "?", seq.size/1024/1024, seq.sequence.camera_make), flush=True)
+        if seq.failed:
+            print(" Failed to download %d/%d images of sequence %r" % (len(seq.failed), seq.total, seq.sequence_name))
+
+    def run_pending(self, timeout=None):
+        # Reports finished sequences, waits up to timeout for the first one
+        try:
+            seq = self.finished.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            self._finish(seq)
+            try:
+                seq = self.finished.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait(self, poll=None):
+        # Blocks until all submitted sequences are done or the engine is
+        # cancelled, calls poll() about once a second
+        while self.active and not self.cancelled:
+            self.run_pending(timeout=1)
+            if poll:
+                poll()
+
+    def cancel(self):
+        # Drops the queued images, the downloads in flight are finished and
+        # recorded. The unfinished sequences stay incomplete in the manifest.
+        self.cancelled = True
+
+    def shutdown(self):
+        with self.delayed_cond:
+            if self.stopping:
+                return
+            self.stopping = True
+            self.delayed_cond.notify()
+        self.scheduler.join()
+        if self.cancelled:
+            # drop the pending resolutions, a model request in flight ends
+            # with its daemon thread
+            self.resolver.terminate()
+        else:
+            self.resolver.close()
+            self.resolver.join()
+        self._stop_workers()
+        if self.packer:
+            self.packer.close()
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class AsyncDownloadEngine(DownloadEngine):
+    # asyncio variant of the download engine: a single event loop thread
+    # runs thousands of downloads in flight with aiohttp instead of one OS
+    # thread per download. Retries, URL refresh and the manifest
+    # are shared with the threaded engine.
+
+    def _start_workers(self, concurrency):
+        import aiohttp
+
+        self.aiohttp = aiohttp
+        self.loop = asyncio.new_event_loop()
+        self.async_jobs = None
+        # workers waiting for a slot of the controller
+        self.slot_waiters = collections.deque()
+        if self.controller:
+            self.controller.on_change = lambda: self.loop.call_soon_threadsafe(self._wake_slots)
+        ready = threading.Event()
+        worker = threading.Thread(
+            target=self._run_loop, args=(concurrency, ready), name="download-async", daemon=True
+        )
+        worker.start()
+        self.workers.append(worker)
+        ready.wait()
+
+    def _run_loop(self, concurrency, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._run_workers(concurrency, ready))
+        finally:
+            self.loop.close()
+
+    async def _run_workers(self, concurrency, ready):
+        aiohttp = self.aiohttp
+        self.async_jobs = asyncio.Queue()
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=HTTP_POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=DOWNLOAD_FILE_TIMEOUT, sock_read=DOWNLOAD_FILE_TIMEOUT
+        )
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            ready.set()
+            await asyncio.gather(
+                *[self._async_worker(session) for i in range(concurrency)]
+            )
+
+    async def _async_worker(self, session):
+        while True:
+            if self.controller:
+                await self._acquire_slot()
+            job = await self.async_jobs.get()
+            if job is None or self.cancelled:
+                if self.controller:
+                    self.controller.release()
+                if job is None:
+                    return
+                continue
+            seq, image_key, sorted_path = job
+            source_url = self._job_url(seq, image_key)
+            if source_url is None:
+                if self.controller:
+                    self.controller.release()
+                continue
+
+            size = False
+            expired = False
+            start = time.time()
+            try:
+                size = await download_file_async(session, image_key, sorted_path, source_url)
+            except URLExpireException as e:
+                if DEBUG >= 1:
+                    print(e)
+                expired = True
+            except (SSLException, DownloadException) as e:
+                print(e)
+            except:
+                print("Unexpected error downloading %r: %r" % (image_key, sys.exc_info()[1]))
+
+            if self.controller:
+                self.controller.release()
+                self.controller.record(time.time() - start, size, size is False and not expired, self.backlog())
+            # manifest, packing and getsize block on the disk
+            await self.loop.run_in_executor(None, self._job_done, seq, image_key, sorted_path, size, expired)
+
+    async def _acquire_slot(self):
+        # waits until a release or a higher limit frees a slot
+        while not self.controller.try_acquire():
+            waiter = self.loop.create_future()
+            self.slot_waiters.append(waiter)
+            await waiter
+
+    def _wake_slots(self):
+        # runs in the event loop, wakes one waiting worker per free slot
+        free = self.controller.free()
+        while free > 0 and self.slot_waiters:
+            waiter = self.slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _put_job(self, job):
+        self.loop.call_soon_threadsafe(self.async_jobs.put_nowait, job)
+
+    def backlog(self):
+        return self.async_jobs.qsize() + self._resolving()
+
+    def _stop_workers(self):
+        for i in range(self.concurrency):
+            self._put_job(None)
+        for worker in self.workers:
+            worker.join()
+
+
+##################################################################################################
+# sequences
+#
+def sequence_paths(output_folder, sequence):
+    # Returns the sequence name, the folder and {image_key: path} of the images of a sequence
     subfolder_enabled = SUBFOLDER
-    
-    if DEBUG >= 3:
-        print(" Prepare sequence download")
-       
-    if DEBUG >= 4:
-        pprint(sequence)
- 
-    sequence_name = (
-        sequence["properties"]["captured_at"]
-        + "_"
-        + sequence["properties"]["created_at"]
-    )
+
+    sequence_name = sequence.captured_at + "_" + sequence.created_at
     if os.name == "nt":
         sequence_name = sequence_name.replace(":", "_")
     sequence_day = sequence_name.split("T")[0]
     sorted_folder = output_folder + "/" + sequence_day
 
     if subfolder_enabled == 1:
-        subfolder = sequence["properties"]["captured_at"]
+        subfolder = sequence.captured_at
         if os.name == "nt":
             subfolder = subfolder.replace(":", "_")
         sorted_folder = sorted_folder + "/" + subfolder
 
-    download_list = []
-    os.makedirs(sorted_folder, exist_ok=True)
-
-    # First pass on image_keys : sorts which one needs downloading
-    image_keys = sequence["properties"]["coordinateProperties"]["image_keys"]
-    for image_index, image_key in enumerate(image_keys, 1):
-        sorted_path = (
+    image_paths = {}
+    for image_index, image_key in enumerate(sequence.image_keys, 1):
+        image_paths[image_key] = (
             sorted_folder + "/" + sequence_name + "_" + "%04d" % image_index + ".jpg"
         )
-        if not os.path.exists(sorted_path):
-            download_list.append(image_key)
-        elif os.stat(sorted_path).st_size == 0:
-            download_list.append(image_key)
+    return sequence_name, sorted_folder, image_paths
+
+
+def download_sequence(engine, output_folder, mpy_token, sequence, username, c, nb_sequences, estimate=None):
+    # Sorts out the missing images of a sequence and hands them over to the engine,
+    # in a dry run to the size estimate
+    if DEBUG >= 3:
+        print(" Prepare sequence download")
+       
+    if DEBUG >= 4:
+        pprint(sequence)
+ 
+    sequence_name, sorted_folder, image_paths = sequence_paths(output_folder, sequence)
+
+    manifest = engine.manifest
+    sequence_key = sequence.key
+    image_keys = sequence.image_keys
+    if not VERIFY and manifest.is_complete(sequence_key, len(image_keys)):
+        if DEBUG >= 2:
+            print(" Sequence %r already fully downloaded" % sequence_name)
+        return 0, 0
+
+    # First pass on image_keys : sorts which one needs downloading
+    if manifest.is_known(sequence_key):
+        downloaded = manifest.downloaded(sequence_key)
+        if VERIFY:
+            broken = []
+            for image_key, (path, size, offset) in downloaded.items():
+                try:
+                    if offset is None and os.stat(path).st_size != size:
+                        broken.append(image_key)
+                    elif offset is not None and os.stat(path).st_size < offset + size:
+                        broken.append(image_key)
+                except OSError:
+                    broken.append(image_key)
+            if broken:
+                print(" Verify: %d/%d images of %r missing or changed on disk" % (len(broken), len(downloaded), sequence_name))
+                manifest.remove(broken)
+                for image_key in broken:
+                    path, size, offset = downloaded.pop(image_key)
+                    # a changed file would be taken for a finished download, the packed
+                    # images get a new copy in the shard
+                    if offset is None:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+    else:
+        # no manifest entries yet, import the images of older runs from disk
+        downloaded = {}
+        for image_index, image_key in enumerate(image_keys, 1):
+            sorted_path = image_paths[image_key]
+            try:
+                size = os.stat(sorted_path).st_size
+            except OSError:
+                continue
+            if size > 0:
+                manifest.add(sequence_key, image_key, image_index, sorted_path, size)
+                downloaded[image_key] = (sorted_path, size, None)
+
+    manifest.add_sequence(sequence_key, len(image_keys))
+    # packed images count wherever their shard is
+    download_list = [
+        image_key
+        for image_key in image_keys
+        if image_key not in downloaded
+        or (downloaded[image_key][2] is None and downloaded[image_key][0] != image_paths[image_key])
+    ]
     if not download_list:
+        manifest.set_complete(sequence_key, True)
         if DEBUG >= 2:
             print(" Sequence %r already fully downloaded" % sequence_name)
         return 0, 0
+    manifest.set_complete(sequence_key, False)
+    os.makedirs(sorted_folder, exist_ok=True)
 
     already_downloaded = len(image_keys) - len(download_list)
     if already_downloaded:
@@ -331,151 +2558,1067 @@ def download_sequence(output_folder, mpy_token, sequence, username, c, nb_sequen
             print(" Already downloaded: %d/%d" % (already_downloaded, len(image_keys)))
 
     if DRY_RUN:
+        if estimate:
+            estimate.add(sequence_name, download_list)
         return 1, len(download_list)
 
-    # Third pass, download if entry is found in dict
-    sequence_dl_retries = 0
-    update_urls = True
-    while download_list and not sequence_dl_retries >= SEQUENCE_DL_MAX_RETRIES:
-        if update_urls:
-            source_urls = get_source_urls(download_list, mpy_token, username)
-            update_urls = False
+    engine.submit(
+        SequenceDownload(sequence, sequence_name, image_paths, download_list, mpy_token, username, c, nb_sequences)
+    )
+    return 1, len(download_list)
 
-        sequence_dl_retries += 1
 
-        # show only on a retry
-        if sequence_dl_retries > 1 and DEBUG >= 1:
-            print("sequence download retries: %s/%s" % (sequence_dl_retries, SEQUENCE_DL_MAX_RETRIES))
+def add(tgt, src):
+    for i in range(len(tgt)):
+        tgt[i] += src[i]
 
-        if len(download_list) > len(source_urls):
-            print(
-                " Missing %d/%d images, will refresh and retry later"
-                % (len(download_list) - len(source_urls), len(download_list))
-            )
-            
-            # if we get nothing wait a little bit
-            if len(download_list) - len(source_urls) == len(download_list):
-                if DEBUG >= 1:
-                    print(" Wait a second due long missing source list")
-                time.sleep(2)
-                
-            sequence_dl_retries -= 1
-            # refresh list after this pass
-            update_urls = True
-
-        pool = ThreadPool(NUM_THREADS)
-        pool_args = []
-        for image_index, image_key in enumerate(image_keys, 1):
-            if image_key in download_list:
-                sorted_path = (
-                    sorted_folder
-                    + "/"
-                    + sequence_name
-                    + "_"
-                    + "%04d" % image_index
-                    + ".jpg"
-                )
-                if image_key in source_urls:
-                    source_url = source_urls[image_key]
-                    pool_args.append((image_key, sorted_path, source_url))
 
-        if DEBUG >= 3:
-            print(" Filling download pool done")
-        
+def shard_order(sequences, shard, shards, shard_by, steal):
+    # Returns the (c, sequence) pairs of the own shard, followed by the other
+    # shards if the worker may steal them. Shards by key are a hash of the
+    # sequence key, shards by date are day ranges with about the same number
+    # of images. Every worker gets the same shards from the same sequence list.
+    if shard_by == "date":
+        images_per_day = {}
+        for c, sequence in sequences:
+            day = sequence.captured_at[:10]
+            nb_images = len(sequence.image_keys)
+            images_per_day[day] = images_per_day.get(day, 0) + nb_images
+        total = max(sum(images_per_day.values()), 1)
+        day_shards = {}
+        before = 0
+        for day in sorted(images_per_day):
+            day_shards[day] = min(shards - 1, before * shards // total)
+            before += images_per_day[day]
+
+    by_shard = [[] for i in range(shards)]
+    for c, sequence in sequences:
+        if shard_by == "date":
+            i = day_shards[sequence.captured_at[:10]]
+        else:
+            i = zlib.crc32(sequence.key.encode()) % shards
+        by_shard[i].append((c, sequence))
+
+    ordered = list(by_shard[shard])
+    if steal:
+        for i in range(1, shards):
+            ordered.extend(by_shard[(shard + i) % shards])
+    return ordered
+
+
+class DownloadBudget:
+    # Download size estimate of the sequences for --order smallest and the
+    # budgets: a sequence is only started if it is expected to fit into the
+    # remaining bytes and, at the throughput of the previous runs, to finish
+    # before the max. duration. The estimate is the number of missing images
+    # times the average recorded image size of the sequence, or of all images.
+
+    def __init__(self, manifest, max_bytes, max_duration, started):
+        self.sizes = manifest.sequence_sizes()
+        self.average_size = manifest.average_image_size() or AVERAGE_IMAGE_SIZE
+        self.throughput = manifest.throughput(THROUGHPUT_RUNS)
+        if self.throughput and MAX_BANDWIDTH:
+            self.throughput = min(self.throughput, MAX_BANDWIDTH * 1000 * 1000 / 8)
+        self.max_bytes = max_bytes
+        self.deadline = started + max_duration if max_duration else None
+        # estimates of the started sequences, replaced by their size once finished
+        self.planned = 0
+        self.estimates = {}
+        self.skipped = 0
+
+    def estimate(self, sequence):
+        nb_images, nb_bytes = self.sizes.get(sequence.key, (0, 0))
+        image_size = nb_bytes / nb_images if nb_images else self.average_size
+        return max(len(sequence.image_keys) - nb_images, 0) * image_size
+
+    def fits(self, sequence):
+        size = self.estimate(sequence)
+        if not size:
+            return True
+        if self.max_bytes and self.planned + size > self.max_bytes:
+            return False
+        if self.deadline and self.throughput:
+            # a sequence longer than the whole window is started when nothing
+            # else is queued, its images are kept for the next run
+            queued = max(self.planned - _METRICS.get("bytes_downloaded"), 0)
+            if queued and time.time() + (queued + size) / self.throughput > self.deadline:
+                return False
+        return True
+
+    def start(self, sequence):
+        self.estimates[sequence.key] = self.estimate(sequence)
+        self.planned += self.estimates[sequence.key]
+
+    def finish(self, sequence_key, size):
+        self.planned += size - self.estimates.pop(sequence_key, 0)
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+class SizeEstimate:
+    # Dry run: sums the real size of the images which would be downloaded.
+    # A sample of the images of every sequence is probed on the server while
+    # the next sequences are checked, the other images count with the mean
+    # size of the sample.
+
+    def __init__(self, mpy_token, username, sample, average_size):
+        from multiprocessing.pool import ThreadPool
+
+        self.mpy_token = mpy_token
+        self.username = username
+        self.sample = sample
+        self.average_size = average_size
+        self.resolver = ThreadPool(URL_THREADS)
+        self.probes = ThreadPool(NUM_THREADS)
+        self.sequences = []  # (sequence_name, nb_images, AsyncResult or None)
+
+    def add(self, sequence_name, download_list):
+        result = None
+        if self.sample:
+            step = max(1, round(1 / self.sample))
+            result = self.resolver.apply_async(self._probe, (download_list[::step],))
+        self.sequences.append((sequence_name, len(download_list), result))
+
+    def _probe(self, image_keys):
+        # Runs in the resolver pool, returns the sizes of the sampled images
         try:
-            for i, image_key in enumerate(pool.imap(download_file, pool_args), 1):
-                if image_key:
-                    download_list.remove(image_key)
-                print(
-                    "  Downloading images #%03d out of %03d round: %d" % (i, len(pool_args), sequence_dl_retries),
-                    end="\r",
-                    flush=True,
-                )
-        except SSLException as e:
-            print(e)
+            source_urls = get_source_urls(image_keys, self.mpy_token, self.username)
         except DownloadException as e:
             print(e)
-        except URLExpireException as e:
-            print(e)
-            sequence_dl_retries -= 1
-            # refresh urls
-            update_urls = True
-        finally:
-            pool.terminate()
-            pool.join()
-    print(" Done sequence %r (%d/%d) %3.1f MB, camera: %s" % (sequence_name, c, nb_sequences, _DOWNLOAD_SEQUENCE_SIZE/1024/1024, sequence["properties"]["camera_make"]), flush=True)
-    _DOWNLOAD_TOTAL_SIZE += _DOWNLOAD_SEQUENCE_SIZE
-    _DOWNLOAD_SEQUENCE_SIZE = 0
-                    
-    return 1, len(source_urls)
+            return []
 
-
-def add(tgt, src):
-    for i in range(len(tgt)):
-        tgt[i] += src[i]
+        def probe(item):
+            try:
+                return probe_image(*item)[0]
+            except (DownloadException, URLExpireException) as e:
+                if DEBUG >= 1:
+                    print(e)
+                return None
+
+        return [size for size in self.probes.map(probe, source_urls.items()) if size is not None]
+
+    def total(self):
+        # Returns (estimated bytes, number of probed images)
+        total = 0
+        nb_probed = 0
+        for sequence_name, nb_images, result in self.sequences:
+            sizes = result.get() if result else []
+            if len(sizes) == nb_images:
+                size = sum(sizes)
+            elif sizes:
+                size = sum(sizes) / len(sizes) * nb_images
+            else:
+                size = self.average_size * nb_images
+            if DEBUG >= 1:
+                print(" Sequence %r: %d images, %2.1f MB (%d probed)" % (sequence_name, nb_images, size / 1024 / 1024, len(sizes)))
+            total += size
+            nb_probed += len(sizes)
+        self.resolver.close()
+        self.probes.close()
+        return total, nb_probed
+
+    def close(self):
+        self.resolver.terminate()
+        self.probes.terminate()
+
+
+def make_engine(manifest):
+    # Returns the download engine selected by ENGINE and ADAPTIVE
+    if ENGINE == "async":
+        concurrency, max_workers = ASYNC_CONCURRENCY, ADAPTIVE_MAX or 10000
+    else:
+        concurrency, max_workers = NUM_THREADS, ADAPTIVE_MAX or 128
+    controller = None
+    if ADAPTIVE:
+        controller = AdaptiveConcurrency(ADAPTIVE_MIN, max_workers, concurrency)
+        concurrency = max_workers
+    if ENGINE == "async":
+        return AsyncDownloadEngine(concurrency, manifest, controller)
+    return DownloadEngine(concurrency, manifest, controller)
 
 
 def main(email, password, username, output_folder, start_date, end_date):
+    # everything the takeout opens is closed again, also after an error,
+    # a library program runs many takeouts in one process
+    _METRICS.open(METRICS_FILE)
+    manifest = control = estimate = engine = prefetched = None
+    try:
+        _METRICS.event("start", username=username, engine=ENGINE, threads=NUM_THREADS, dry_run=DRY_RUN)
+        manifest = Manifest(output_folder)
+        control = RuntimeControl(output_folder)
+        control.poll()
+        mpy_token = get_mpy_auth(email, password)
+        accumulated_stats = [0, 0]  # seq, img,
+        if DRY_RUN:
+            estimate = SizeEstimate(mpy_token, username, SIZE_SAMPLE, manifest.average_image_size() or AVERAGE_IMAGE_SIZE)
+        engine = make_engine(manifest)
+        if PACK_BY:
+            engine.packer = PackedOutput(output_folder, PACK_BY, PACK_SIZE, "-%d" % (SHARD + 1) if SHARDS > 1 else "")
+        download_started = time.time()
+        leases = None
+        if LEASES and not DRY_RUN:
+            leases = SequenceLeases(manifest, WORKER_ID)
+            print("Worker %s, shard %d/%d by %s" % (WORKER_ID, SHARD + 1, SHARDS, SHARD_BY))
+        budget = None
+        if ORDER == "smallest" or MAX_BYTES or MAX_DURATION:
+            budget = DownloadBudget(manifest, MAX_BYTES, MAX_DURATION, download_started)
+            engine.max_bytes = MAX_BYTES
+
+        def on_finish(seq):
+            if leases:
+                leases.release(seq.sequence_key)
+            if budget:
+                budget.finish(seq.sequence_key, seq.size)
+
+        engine.on_finish = on_finish
+
+        def poll():
+            control.poll()
+            if leases:
+                leases.poll()
+            if budget and budget.expired() and not engine.cancelled:
+                print("Reached the max. duration, stopping the download")
+                engine.cancel()
+            if _STOP.is_set() and not engine.cancelled:
+                engine.cancel()
+
+        def start_sequence(c, sequence):
+            sequence_key = sequence.key
+            if budget and not budget.fits(sequence):
+                budget.skipped += 1
+                if DEBUG >= 1:
+                    print("Sequence %s_%s (%d/%s) skipped, about %2.1f MB don't fit into the budget" % (
+                        sequence.captured_at, sequence.created_at, c, nb_sequences or "?",
+                        budget.estimate(sequence) / 1024 / 1024))
+                return True
+            if leases and not leases.claim(sequence_key):
+                return False
+            stats = download_sequence(engine, output_folder, mpy_token, sequence, username, c, nb_sequences, estimate)
+            add(accumulated_stats, stats)
+            if leases and not stats[0]:
+                # nothing to download, the engine won't finish it
+                leases.release(sequence_key)
+            if budget and stats[0]:
+                budget.start(sequence)
+
+            if DEBUG >= 2:
+                print(
+                    "Sequence %s_%s (%d/%s) contains %d images camera: %s"
+                    % (
+                        sequence.captured_at,
+                        sequence.created_at,
+                        c,
+                        nb_sequences or "?",
+                        stats[1],
+                        sequence.camera_make,
+                    )
+                )
+            return True
+
+        listing = iter_user_sequences(mpy_token, username, start_date, end_date, manifest)
+        if ORDER != "newest" or SHARDS > 1:
+            # the order needs the full sequence list
+            user_sequences = list(listing)
+            nb_sequences = len(user_sequences)
+            if ORDER == "oldest":
+                user_sequences.reverse()
+            elif ORDER == "smallest":
+                user_sequences.sort(key=budget.estimate)
+            elif ORDER == "date":
+                user_sequences.sort(key=lambda sequence: sequence.captured_at)
+            sequences = list(enumerate(user_sequences, 1))
+            if SHARDS > 1:
+                sequences = shard_order(sequences, SHARD, SHARDS, SHARD_BY, leases is not None)
+        else:
+            # download while the listing fetches the next pages
+            nb_sequences = None
+            prefetched = prefetch(listing, LISTING_PREFETCH, idle=lambda: (engine.run_pending(timeout=0), poll()))
+            sequences = enumerate(prefetched, 1)
+        nb_listed = 0
+        leased_elsewhere = []
+        for c, sequence in sequences:
+            nb_listed += 1
+            # keep the workers busy, but prepare the next sequence before they run dry
+            while engine.backlog() > engine.concurrency * 2 and not engine.cancelled:
+                engine.run_pending(timeout=0.1)
+                poll()
+            engine.run_pending(timeout=0)
+            if engine.cancelled:
+                break
+
+            if not start_sequence(c, sequence):
+                leased_elsewhere.append((c, sequence))
+        if prefetched is not None:
+            # a cancelled download leaves the listing thread, stop it before the manifest is closed
+            prefetched.close()
+
+        # sequences of other workers: wait until they are finished, or take
+        # them over once the lease of a crashed worker has expired
+        while leased_elsewhere and not engine.cancelled:
+            if DEBUG >= 1:
+                print("Waiting for %d sequences leased by other workers" % len(leased_elsewhere))
+            deadline = time.time() + LEASE_RETRY
+            while time.time() < deadline and not engine.cancelled:
+                engine.run_pending(timeout=1)
+                poll()
+            waiting = []
+            for c, sequence in leased_elsewhere:
+                if leases.finished(sequence.key):
+                    continue
+                if not start_sequence(c, sequence):
+                    waiting.append((c, sequence))
+            leased_elsewhere = waiting
+
+        engine.wait(poll)
+        engine.shutdown()
+        if engine.cancelled and leases:
+            leases.abandon()
+        if not nb_listed:
+            if _STOP.is_set():
+                raise TakeoutError("Takeout cancelled, the next run lists the sequences again", 1)
+            raise TakeoutError(
+                "No sequences found to download. Check this is the valid username at https://www.mapillary.com/app/user/%s"
+                % username, -2
+            )
+        if not DRY_RUN and _METRICS.get("bytes_downloaded"):
+            manifest.add_run(download_started, time.time() - download_started, _METRICS.get("images_downloaded"),
+                             _METRICS.get("bytes_downloaded"), ENGINE, engine.concurrency)
+
+        if DEBUG >= 1 and ENGINE == "threads":
+            nb_requests, nb_connections = connection_stats()
+            print("HTTP requests: %d, new connections: %d, reused connections: %d" % (
+                nb_requests, nb_connections, max(nb_requests - nb_connections, 0)))
+
+        if DRY_RUN:
+            print(
+                "%s images in %s sequences would have been downloaded without the dry run"
+                % (accumulated_stats[1], accumulated_stats[0],)
+            )
+            download_size, nb_probed = estimate.total()
+            throughput = manifest.throughput(THROUGHPUT_RUNS)
+            if throughput and MAX_BANDWIDTH:
+                throughput = min(throughput, MAX_BANDWIDTH * 1000 * 1000 / 8)
+
+            if accumulated_stats[1] == 0:
+                if not (budget and budget.skipped):
+                    print("You are up-to-date, all images are already downloaded. Great!")
+            elif throughput:
+                print("Estimated download size: %2.1f GB (%d images probed)" % (download_size / 1024/1024/1024, nb_probed))
+                print("Estimated download time at %2.1f Mbit/s measured in previous runs: %2.1f min" % (
+                    throughput * 8 / 1000 / 1000, download_size / throughput / 60))
+            else:
+                print("Estimated download size: %2.1f GB (%d images probed)" % (download_size / 1024/1024/1024, nb_probed))
+                print("Estimated download time 250Mbit/s: %2.1f min, 100Mbit/s: %2.1f min, 50Mbit/s: %2.1f min, 16Mbit/s %2.1f min" % (
+                    (download_size / 250/1000/1000*8/60),
+                    (download_size / 100/1000/1000*8/60),
+                    (download_size /  50/1000/1000*8/60),
+                    (download_size /  16/1000/1000*8/60),
+                ))
+
+        else:
+            total_size = _METRICS.get("bytes_downloaded")
+            nb_downloaded = _METRICS.get("images_downloaded")
+            if accumulated_stats[1] > 0:
+                print("Total images: %s total download size: %2.1f GB average image size: %2.1f MB" %
+                    (nb_downloaded,
+                    total_size/1024/1024/1024,
+                    total_size/max(nb_downloaded, 1)/1024/1024))
+            elif not (budget and budget.skipped):
+                print("You are up-to-date, all images are already downloaded. Great!")
+
+        if _STOP.is_set():
+            print("Takeout cancelled, the next run continues with the unfinished sequences")
+        elif engine.cancelled:
+            print("Stopped at the max. %s, the next run continues with the unfinished sequences" % (
+                "bytes" if MAX_BYTES and _METRICS.get("bytes_downloaded") >= MAX_BYTES else "duration"))
+        elif budget and budget.skipped:
+            print("Reached the budget, %d sequences skipped, the next run continues with them" % budget.skipped)
+        if budget and (budget.skipped or engine.cancelled):
+            _METRICS.event("budget", skipped=budget.skipped, stopped=engine.cancelled)
+
+        _METRICS.event("end", duration=round(time.time() - _METRICS.started, 3), **_METRICS.snapshot())
+        if PROMETHEUS_FILE:
+            _METRICS.write_prometheus(PROMETHEUS_FILE)
+        return 1 if _STOP.is_set() else 0
+
+    finally:
+        if prefetched is not None:
+            prefetched.close()
+        if engine:
+            engine.cancel()
+            engine.shutdown()
+        if estimate:
+            estimate.close()
+        if manifest:
+            manifest.close()
+        if control:
+            control.close()
+        _METRICS.close()
+
+def run_workers(nb_workers, email, password, username, output_folder, start_date, end_date, worker_args):
+    # Coordinator: caches the sequence list in the manifest once, then starts
+    # one worker process per shard. The workers only fetch sequences created
+    # since then and claim sequences through leases, so the sequences of a
+    # crashed worker are taken over by the others.
+    manifest = Manifest(output_folder)
     mpy_token = get_mpy_auth(email, password)
-    user_sequences, nb_sequences = get_user_sequences(
-        mpy_token, username, start_date, end_date
-    )
+    nb_sequences = sum(1 for sequence in iter_user_sequences(mpy_token, username, start_date, end_date, manifest))
+    manifest.close()
     if not nb_sequences:
-        print(
+        raise TakeoutError(
             "No sequences found to download. Check this is the valid username at https://www.mapillary.com/app/user/%s"
-            % username
+            % username, -2
         )
-        sys.exit(-2)
-    accumulated_stats = [0, 0]  # seq, img,
-    for c, sequence in enumerate(reversed(user_sequences), 1):
-        stats = download_sequence(output_folder, mpy_token, sequence, username, c, nb_sequences )
-        add(accumulated_stats, stats)
-        
-        if DEBUG >= 2:
-            print(
-                "Sequence %s_%s (%d/%d) contains %d images camera: %s"
-                % (
-                    sequence["properties"]["captured_at"],
-                    sequence["properties"]["created_at"],
-                    c,
-                    nb_sequences,
-                    stats[1],
-                    sequence["properties"]["camera_make"],
-                )
+
+    print("Starting %d workers for %d sequences" % (nb_workers, nb_sequences))
+    workers = []
+    for i in range(nb_workers):
+        command = [sys.executable, os.path.abspath(__file__)] + worker_args + [
+            "--shard", "%d/%d" % (i + 1, nb_workers), "--lease"]
+        workers.append(subprocess.Popen(command))
+
+    result = 0
+    for i, worker in enumerate(workers, 1):
+        returncode = worker.wait()
+        if returncode:
+            print("Worker %d/%d exited with code %d" % (i, nb_workers, returncode))
+            result = returncode
+    return result
+
+
+
+##################################################################################################
+# verify
+#
+def check_image(path, checksum, offset=0, size=None):
+    # Returns (size, error, md5) of an image file, or of the image at offset
+    # in a tar shard. The file is mapped into memory, only the JPEG markers
+    # are read unless the checksum is needed.
+    try:
+        with open(path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if size is None:
+                size = file_size
+            elif file_size < offset + size:
+                return size, "shard truncated", None
+            if size < len(JPEG_SOI) + len(JPEG_EOI):
+                return size, "empty", None
+            end = offset + size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[offset : offset + len(JPEG_SOI)] != JPEG_SOI:
+                    return size, "no JPEG start marker", None
+                if data.rfind(JPEG_EOI, max(offset + len(JPEG_SOI), end - JPEG_EOI_WINDOW), end) < 0:
+                    return size, "no JPEG end marker, truncated", None
+                md5 = None
+                if checksum:
+                    with memoryview(data) as view:
+                        md5 = hashlib.md5(view[offset:end]).hexdigest()
+    except FileNotFoundError:
+        return None, "missing", None
+    except (OSError, ValueError) as e:
+        return None, str(e), None
+    return size, None, md5
+
+
+def check_images(batch):
+    # Runs in a verify process, one task per VERIFY_BATCH images
+    return [check_image(path, checksum, offset, size) for path, checksum, offset, size in batch]
+
+
+def check_remote(local, failed, mpy_token, username):
+    # Compares the size and checksum of the images on disk with the server.
+    # URLs are resolved chunk by chunk and probed right away, before they expire.
+    # Returns the number of images which could not be checked.
+    from multiprocessing.pool import ThreadPool
+
+    image_keys = sorted(local)
+    chunks = [
+        image_keys[x : x + REQUESTS_PER_CALL]
+        for x in range(0, len(image_keys), REQUESTS_PER_CALL)
+    ]
+    probes = ThreadPool(NUM_THREADS)
+
+    def probe(item):
+        image_key, source_url = item
+        try:
+            return image_key, probe_image(image_key, source_url)
+        except (DownloadException, URLExpireException) as e:
+            if DEBUG >= 1:
+                print(e)
+            return image_key, None
+
+    def check_chunk(chunk):
+        try:
+            source_urls = get_source_urls(chunk, mpy_token, username)
+        except DownloadException as e:
+            print(e)
+            source_urls = {}
+        return len(chunk), probes.map(probe, source_urls.items())
+
+    unchecked = 0
+    checked = 0
+    with ThreadPool(URL_THREADS) as resolver:
+        for nb_images, results in resolver.imap_unordered(check_chunk, chunks):
+            unchecked += nb_images - len(results)
+            for image_key, result in results:
+                if result is None:
+                    unchecked += 1
+                    continue
+                server_size, etag = result
+                size, md5 = local[image_key]
+                if size != server_size:
+                    failed[image_key] = "size %d, on the server %d" % (size, server_size)
+                elif md5 and etag and re.match("^[0-9a-f]{32}$", etag) and md5 != etag:
+                    failed[image_key] = "checksum differs from the server"
+            checked += nb_images
+            print("  Compared images #%d out of %d with the server" % (checked, len(image_keys)), end="\r", flush=True)
+    probes.close()
+    print("")
+    return unchecked
+
+
+def verify_archive(email, password, username, output_folder, start_date, end_date):
+    # verify command: checks every image of the sequences on disk and optionally
+    # with the server, brings the manifest up to date and with VERIFY_REPAIR
+    # downloads the failing images again. Returns 1 if failing images are left.
+    from concurrent.futures import ProcessPoolExecutor
+
+    _METRICS.open(METRICS_FILE)
+    manifest = engine = None
+    try:
+        manifest = Manifest(output_folder)
+        mpy_token = get_mpy_auth(email, password)
+        user_sequences = list(iter_user_sequences(mpy_token, username, start_date, end_date, manifest))
+        nb_sequences = len(user_sequences)
+        if not nb_sequences:
+            raise TakeoutError(
+                "No sequences found to verify. Check this is the valid username at https://www.mapillary.com/app/user/%s"
+                % username, -2
             )
-    if DRY_RUN:
-        print(
-            "%s images in %s sequences would have been downloaded without the dry run"
-            % (accumulated_stats[1], accumulated_stats[0],)
-        )
-        download_size = accumulated_stats[1] * AVERAGE_IMAGE_SIZE;
 
-        if accumulated_stats[1] == 0:
-            print("You are up-to-date, all images are already downloaded. Great!")
-        else:
-            print("Estimated download size: %2.1f GB" % (download_size / 1024/1024/1024))
-            print("Estimated download time 250Mbit/s: %2.1f min, 100Mbit/s: %2.1f min, 50Mbit/s: %2.1f min, 16Mbit/s %2.1f min" % (
-                (download_size / 250/1000/1000*8/60),
-                (download_size / 100/1000/1000*8/60),
-                (download_size /  50/1000/1000*8/60),
-                (download_size /  16/1000/1000*8/60),
-            ))
+        images = []  # (image_key, path, pack offset, size)
+        for sequence in user_sequences:
+            downloaded = manifest.downloaded(sequence.key)
+            for image_key, path in sequence_paths(output_folder, sequence)[2].items():
+                if image_key in downloaded and downloaded[image_key][2] is not None:
+                    # packed image
+                    path, size, offset = downloaded[image_key]
+                    images.append((image_key, path, offset, size))
+                else:
+                    images.append((image_key, path, 0, None))
+        print("Verify %d images of %d sequences" % (len(images), nb_sequences))
+
+        start = time.time()
+        batches = [
+            [(path, VERIFY_CHECKSUM, offset, size) for image_key, path, offset, size in images[x : x + VERIFY_BATCH]]
+            for x in range(0, len(images), VERIFY_BATCH)
+        ]
+        results = []
+        with ProcessPoolExecutor(VERIFY_PROCESSES or None) as pool:
+            for batch in pool.map(check_images, batches):
+                results.extend(batch)
+                print("  Checked images #%d out of %d" % (len(results), len(images)), end="\r", flush=True)
+                _METRICS.notify("verify_progress", checked=len(results), total=len(images))
+        print("")
+
+        local = {}  # image_key: (size, md5)
+        failed = {}  # image_key: error
+        missing = set()
+        for (image_key, path, offset, packed_size), (size, error, md5) in zip(images, results):
+            if error == "missing":
+                missing.add(image_key)
+            elif error:
+                failed[image_key] = error
+            else:
+                local[image_key] = (size, md5)
+        elapsed = time.time() - start
+        print("Checked %d images on disk in %2.1f sec. (%d images/sec.)" % (
+            len(images), elapsed, len(images) / elapsed if elapsed else 0))
+
+        if VERIFY_REMOTE:
+            unchecked = check_remote(local, failed, mpy_token, username)
+            if unchecked:
+                print("Could not compare %d images with the server" % unchecked)
+
+        # the manifest lists exactly the good images
+        repair = []
+        for sequence in user_sequences:
+            sequence_key = sequence.key
+            sequence_name, sorted_folder, image_paths = sequence_paths(output_folder, sequence)
+            downloaded = manifest.downloaded(sequence_key)
+            bad = []
+            for image_index, (image_key, path) in enumerate(image_paths.items(), 1):
+                packed = image_key in downloaded and downloaded[image_key][2] is not None
+                if image_key in failed:
+                    bad.append(image_key)
+                    if packed:
+                        print(" %s at %d: %s" % (downloaded[image_key][0], downloaded[image_key][2], failed[image_key]))
+                    else:
+                        print(" %s: %s" % (path, failed[image_key]))
+                elif image_key in local and not packed and downloaded.get(image_key) != (path, local[image_key][0], None):
+                    manifest.add(sequence_key, image_key, image_index, path, local[image_key][0])
+            manifest.remove([k for k in image_paths if k in downloaded and (k in failed or k in missing)])
+            manifest.add_sequence(sequence_key, len(image_paths))
+            manifest.set_complete(sequence_key, all(k in local and k not in failed for k in image_paths))
+            if bad:
+                repair.append((sequence, bad))
+                # the next takeout would take a failing file for a finished download,
+                # packed images stay in their shard, the new copy is appended
+                for image_key in bad:
+                    if os.path.exists(image_paths[image_key]):
+                        os.remove(image_paths[image_key])
+
+        nb_ok = len([k for k in local if k not in failed])
+        print("%d images ok, %d failing, %d not downloaded yet" % (nb_ok, len(failed), len(missing)))
+        _METRICS.event("verify", images=len(images), failed=len(failed), missing=len(missing))
+
+        if VERIFY_REPAIR and repair:
+            print("Download %d failing images of %d sequences again" % (len(failed), len(repair)))
+            engine = make_engine(manifest)
+            if PACK_BY:
+                engine.packer = PackedOutput(output_folder, PACK_BY, PACK_SIZE)
+            # only the failing images, the missing ones are left to the takeout
+            for c, (sequence, bad) in enumerate(repair, 1):
+                sequence_name, sorted_folder, image_paths = sequence_paths(output_folder, sequence)
+                os.makedirs(sorted_folder, exist_ok=True)
+                engine.submit(
+                    SequenceDownload(sequence, sequence_name, image_paths, bad, mpy_token, username, c, len(repair))
+                )
+            engine.wait(lambda: _STOP.is_set() and engine.cancel())
+            engine.shutdown()
+            downloaded = {}
+            for sequence, bad in repair:
+                sequence_downloaded = manifest.downloaded(sequence.key)
+                manifest.set_complete(sequence.key, all(k in sequence_downloaded for k in sequence.image_keys))
+                downloaded.update(sequence_downloaded)
+            nb_failed = len(failed)
+            failed = {k: v for k, v in failed.items() if k not in downloaded}
+            print("Repaired %d/%d images" % (nb_failed - len(failed), nb_failed))
+
+        return 1 if failed else 0
+    finally:
+        if engine:
+            engine.cancel()
+            engine.shutdown()
+        if manifest:
+            manifest.close()
+        _METRICS.close()
+
+
 
+##################################################################################################
+# layout migration
+#
+def plan_migration(output_folder, to_subfolder):
+    # Returns the (source, destination) paths of the images which are not in
+    # the target layout, with one scandir() per day folder and sequence subfolder
+    day_pattern = re.compile(r"^\d{4}-\d\d-\d\d$")
+    moves = []
+    with os.scandir(output_folder) as days:
+        for day in days:
+            if not day.is_dir() or not day_pattern.match(day.name):
+                continue
+            with os.scandir(day.path) as entries:
+                for entry in entries:
+                    if to_subfolder and entry.name.endswith(".jpg") and "Z_" in entry.name and entry.is_file():
+                        # the subfolder is the capture time of the sequence
+                        subfolder = entry.name[: entry.name.index("Z_") + 1]
+                        moves.append((entry.path, os.path.join(day.path, subfolder, entry.name)))
+                    elif not to_subfolder and entry.is_dir():
+                        with os.scandir(entry.path) as images:
+                            for image in images:
+                                if image.name.endswith(".jpg") and image.is_file():
+                                    moves.append((image.path, os.path.join(day.path, image.name)))
+    return moves
+
+
+def move_image(move):
+    # Runs in the migration pool, returns True if the image was moved.
+    # A missing source with an existing destination was moved before a crash.
+    source, destination = move
+    try:
+        os.rename(source, destination)
+    except FileNotFoundError:
+        if not os.path.exists(destination):
+            print(" Missing image %r" % source)
+        return False
+    return True
+
+
+def migrate_layout(output_folder, to_subfolder):
+    # migrate-layout command: moves the images between the flat layout and the
+    # subfolder layout. The moves are planned into a journal first, so an
+    # interrupted migration is resumed from the journal and the manifest is
+    # updated only once all images are in place.
+    from multiprocessing.pool import ThreadPool
+
+    journal = os.path.join(output_folder, MIGRATE_JOURNAL)
+    if os.path.exists(journal):
+        with open(journal) as f:
+            header = json.loads(f.readline())
+            moves = [json.loads(line) for line in f]
+        to_subfolder = header["to"] == "subfolder"
+        print("Resume interrupted migration to the %s layout" % header["to"])
     else:
-        global _DOWNLOAD_TOTAL_SIZE
-        if accumulated_stats[1] > 0:
-            print("Total images: %s total download size: %2.1f GB average image size: %2.1f MB" %
-                (accumulated_stats[1],
-                _DOWNLOAD_TOTAL_SIZE/1024/1024/1024,
-                _DOWNLOAD_TOTAL_SIZE/accumulated_stats[1]/1024/1024))
-        else:
-            print("You are up-to-date, all images are already downloaded. Great!")
-            
+        start = time.time()
+        moves = [
+            [os.path.relpath(path, output_folder) for path in move]
+            for move in plan_migration(output_folder, to_subfolder)
+        ]
+        print("Found %d images to move in %2.1f sec." % (len(moves), time.time() - start))
+        if not moves:
+            print("All images are already in the %s layout" % ("subfolder" if to_subfolder else "flat"))
+            return 0
+        tmp_journal = journal + ".tmp"
+        with open(tmp_journal, "w") as f:
+            f.write(json.dumps({"to": "subfolder" if to_subfolder else "flat"}) + "\n")
+            for move in moves:
+                f.write(json.dumps(move) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_journal, journal)
+
+    moves = [(os.path.join(output_folder, source), os.path.join(output_folder, destination)) for source, destination in moves]
+    for folder in sorted({os.path.dirname(destination) for source, destination in moves}):
+        os.makedirs(folder, exist_ok=True)
+
+    start = time.time()
+    moved = 0
+    with ThreadPool(NUM_THREADS) as pool:
+        for i, done in enumerate(pool.imap_unordered(move_image, moves, chunksize=64), 1):
+            moved += done
+            if i % 1000 == 0 or i == len(moves):
+                print("  Moved images #%d out of %d" % (i, len(moves)), end="\r", flush=True)
+    print("")
+    print("Moved %d images in %2.1f sec." % (moved, time.time() - start))
+
+    if os.path.exists(os.path.join(output_folder, MANIFEST_FILE)):
+        manifest = Manifest(output_folder)
+        manifest.move(moves)
+        manifest.close()
+
+    if not to_subfolder:
+        for folder in {os.path.dirname(source) for source, destination in moves}:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+    os.remove(journal)
+    print("Done, run the takeout %s --subfolder from now on" % ("with" if to_subfolder else "without"))
     return 0
 
 
+def query_index(output_folder, bbox, start_date, end_date, sequence_key):
+    # query command: prints the downloaded images in a bounding box and date
+    # range from the location index in the manifest, one tab separated line
+    # per image. Packed images are "<shard>@<offset>:<size>".
+    if not os.path.exists(os.path.join(output_folder, MANIFEST_FILE)):
+        print("No manifest in %r, run the takeout first" % output_folder, file=sys.stderr)
+        return 1
+    manifest = Manifest(output_folder)
+    start = time.time()
+    rows = manifest.query_locations(bbox, start_date, end_date, sequence_key)
+    elapsed = time.time() - start
+    manifest.close()
+
+    for image_key, sequence_key, captured_at, lon, lat, path, offset, size in rows:
+        if offset is not None:
+            path = "%s@%d:%d" % (path, offset, size)
+        print("%.7f\t%.7f\t%s\t%s\t%s\t%s" % (lon, lat, captured_at, sequence_key, image_key, path))
+    print("Found %d images in %.1f ms" % (len(rows), elapsed * 1000), file=sys.stderr)
+    return 0
+
+
+def run_command(function, *args):
+    # Runs a command function for the command line, returns the exit code
+    try:
+        return function(*args)
+    except TakeoutError as e:
+        print(e)
+        return e.code
+
+
+##################################################################################################
+# library API
+#
+class TakeoutConfig:
+    # Options of a takeout started by TakeoutClient. The keywords are the long
+    # command line options with underscores and the same units, e.g.
+    # TakeoutConfig(threads=32, subfolder=True, max_bandwidth=100, shard=(1, 4)).
+    # Options which are not given keep the defaults of the module.
+
+    # keyword: (module setting, factor)
+    OPTIONS = {
+        "debug": ("DEBUG", None),
+        "timeout": ("DOWNLOAD_FILE_TIMEOUT", None),
+        "timeout_meta": ("META_TIMEOUT", None),
+        "threads": ("NUM_THREADS", None),
+        "engine": ("ENGINE", None),
+        "concurrency": ("ASYNC_CONCURRENCY", None),
+        "adaptive": ("ADAPTIVE", None),
+        "min_workers": ("ADAPTIVE_MIN", None),
+        "max_workers": ("ADAPTIVE_MAX", None),
+        "url_threads": ("URL_THREADS", None),
+        "pool_size": ("HTTP_POOL_SIZE", None),
+        "buffer_size": ("DOWNLOAD_BUFFER_SIZE", 1024),
+        "retries": ("IMAGE_DL_MAX_RETRIES", None),
+        "dry_run": ("DRY_RUN", None),
+        "size_sample": ("SIZE_SAMPLE", None),
+        "metrics_file": ("METRICS_FILE", None),
+        "prometheus_file": ("PROMETHEUS_FILE", None),
+        "full_refresh": ("FULL_REFRESH", None),
+        "order": ("ORDER", None),
+        "max_bytes": ("MAX_BYTES", None),
+        "max_duration": ("MAX_DURATION", None),
+        "verify": ("VERIFY", None),
+        "subfolder": ("SUBFOLDER", None),
+        "pack": ("PACK_BY", None),
+        "pack_size": ("PACK_SIZE", 1024 * 1024),
+        "shard_by": ("SHARD_BY", None),
+        "lease": ("LEASES", None),
+        "worker_id": ("WORKER_ID", None),
+        "lease_ttl": ("LEASE_TTL", None),
+        "wal": ("MANIFEST_WAL", None),
+        "processes": ("VERIFY_PROCESSES", None),
+        "remote": ("VERIFY_REMOTE", None),
+        "checksum": ("VERIFY_CHECKSUM", None),
+        "repair": ("VERIFY_REPAIR", None),
+    }
+    # keywords with a setter
+    SETTERS = ("api_endpoint", "max_bandwidth", "meta_rate", "shard")
+
+    def __init__(self, **options):
+        for name in options:
+            if name not in self.OPTIONS and name not in self.SETTERS:
+                raise TypeError("unknown takeout option %r" % name)
+        self.options = options
+
+    def apply(self, module):
+        # Sets the settings of the takeout module, see _takeout_module()
+        settings = vars(module)
+        for name, value in self.options.items():
+            if name == "api_endpoint":
+                module.set_api_endpoint(value)
+            elif name == "max_bandwidth":
+                module.set_max_bandwidth(value)
+            elif name == "meta_rate":
+                module.set_meta_rate(value)
+            elif name == "shard":
+                settings["SHARD"], settings["SHARDS"] = value[0] - 1, value[1]
+            else:
+                setting, factor = self.OPTIONS[name]
+                settings[setting] = value * factor if factor else value
+        if self.options.get("checksum"):
+            settings["VERIFY_REMOTE"] = True
+
+
+def _takeout_module():
+    # A private copy of this module for one takeout, with its own settings,
+    # metrics, rate limiters, HTTP sessions and stop event
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("_mapillary_takeout", __file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the verify processes look the function up by the name of this module
+    module.check_images = check_images
+    return module
+
+
+def _message_printer(events):
+    # print() of a takeout module: every message becomes a "message" event,
+    # the progress lines ending in \r are replaced by the progress events
+    def printer(*values, sep=" ", end="\n", file=None, flush=False):
+        if end == "\r":
+            return
+        text = sep.join(str(value) for value in values).strip()
+        if text:
+            events.put({"event": "message", "text": text, "ts": round(time.time(), 3)})
+
+    return printer
+
+
+def _run_takeout(module, command, options, arguments, events):
+    # Thread of a takeout started by TakeoutClient
+    code = 1
+    try:
+        TakeoutConfig(**options).apply(module)
+        module._METRICS.listeners.append(events.put)
+        module.print = _message_printer(events)
+        code = {"download": module.main, "verify": module.verify_archive}[command](*arguments)
+    except module.TakeoutError as e:
+        events.put({"event": "error", "message": str(e), "ts": round(time.time(), 3)})
+        code = e.code
+    except Exception as e:
+        import traceback
+        events.put({"event": "error", "message": "%s: %s" % (type(e).__name__, e),
+                    "traceback": traceback.format_exc(), "ts": round(time.time(), 3)})
+    finally:
+        events.put({"event": "exit", "code": code, "ts": round(time.time(), 3)})
+
+
+class Takeout:
+    # A takeout started by TakeoutClient.start(). The events are dicts with the
+    # kind in "event": the metric events of --metrics-file, "image_done" and
+    # "verify_progress" for the progress, "message" for the other messages,
+    # "error" and finally "exit" with the exit code.
+
+    def __init__(self, module, thread, events, on_event=None):
+        self.module = module
+        self.thread = thread
+        self.queue = events
+        self.returncode = None
+        self.reader = None
+        if on_event:
+            self.reader = threading.Thread(target=self._call, args=(on_event,), name="takeout-events", daemon=True)
+            self.reader.start()
+
+    def _call(self, on_event):
+        for event in self.events():
+            on_event(event)
+
+    def events(self, timeout=None):
+        # Yields the events until the takeout exits or timeout seconds passed.
+        # Only one consumer: either this iterator or the on_event callback.
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.returncode is None:
+            wait = 1
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return
+            try:
+                event = self.queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if event["event"] == "exit":
+                self.thread.join()
+                self.returncode = event["code"]
+            yield event
+
+    def wait(self, timeout=None):
+        # Returns the exit code, or None if the takeout still runs after timeout
+        if self.reader:
+            self.reader.join(timeout)
+            return self.returncode
+        for event in self.events(timeout):
+            pass
+        return self.returncode
+
+    def cancel(self):
+        # Stops the takeout at its next check, the images in flight are
+        # finished. A later takeout of the account continues where it stopped.
+        self.module._STOP.set()
+
+
+class TakeoutClient:
+    # Runs the takeouts of several accounts at the same time in a long running
+    # program instead of a command line per account:
+    #
+    #   client = TakeoutClient(TakeoutConfig(threads=32, subfolder=True))
+    #   takeout = client.start(email, password, username, output_folder)
+    #   for event in takeout.events():
+    #       ...
+    #
+    # Every takeout runs in a thread with a private copy of the module, so
+    # the takeouts keep their own settings, metrics and rate limits.
+
+    def __init__(self, config=None):
+        self.config = config or TakeoutConfig()
+
+    def start(self, email, password, username, output_folder, start_date=None, end_date=None,
+              config=None, on_event=None, command="download"):
+        # Starts the takeout, command "download" or "verify", returns a Takeout
+        if command not in ("download", "verify"):
+            raise ValueError("unknown takeout command %r" % command)
+        module = _takeout_module()
+        events = queue.Queue()
+        thread = threading.Thread(
+            target=_run_takeout,
+            args=(module, command, (config or self.config).options,
+                  (email, password, username, output_folder, start_date, end_date), events),
+            name="takeout-" + username,
+            daemon=True,
+        )
+        thread.start()
+        return Takeout(module, thread, events, on_event)
+
+    def run(self, *args, **kwargs):
+        # Runs the takeout to the end, returns the exit code
+        return self.start(*args, **kwargs).wait()
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Download your images from Mapillary, version: " + VERSION)
+    # an optional command in front of the arguments, the options are shared
+    commands = {
+        "verify": "Check the downloaded images and download broken ones again",
+        "migrate-layout": "Move the images between the flat and the subfolder layout",
+        "query": "List the downloaded images in a bounding box and date range",
+    }
+    command = None
+    argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        command = argv.pop(0)
+
+    if command == "migrate-layout":
+        # works on the output folder only, no account options
+        parser = argparse.ArgumentParser(
+            prog=os.path.basename(sys.argv[0]) + " " + command,
+            description=commands[command] + ", version: " + VERSION,
+        )
+        parser.add_argument("output_folder", help="Download destination")
+        parser.add_argument( "--to", choices=["subfolder", "flat"], default="subfolder", help="target layout, default: subfolder")
+        parser.add_argument( "--threads", metavar="1..128",  help="number of parallel renames, default: " + str(NUM_THREADS))
+        args = parser.parse_args(argv)
+        if args.threads:
+            try:
+                threads = int(args.threads)
+            except:
+                print("illegal value for threads: %s" % args.threads)
+                sys.exit(-1)
+            if threads > 0 and threads <= 128:
+                NUM_THREADS = threads
+            else:
+                print ("threads parameter is out of range 1..128: %s, ignored" % threads)
+        exit(migrate_layout(args.output_folder, args.to == "subfolder"))
+
+    if command == "query":
+        # reads the location index of the manifest, no account options
+        parser = argparse.ArgumentParser(
+            prog=os.path.basename(sys.argv[0]) + " " + command,
+            description=commands[command] + ", version: " + VERSION,
+        )
+        parser.add_argument("output_folder", help="Download destination")
+        parser.add_argument("--bbox", metavar="MINLON,MINLAT,MAXLON,MAXLAT", help="bounding box in degrees")
+        parser.add_argument("--start-date", metavar="YYYY-MM-DD", help="images captured since this date")
+        parser.add_argument("--end-date", metavar="YYYY-MM-DD", help="images captured before this date")
+        parser.add_argument("--sequence", metavar="KEY", help="images of this sequence")
+        args = parser.parse_args(argv)
+        bbox = None
+        if args.bbox:
+            try:
+                bbox = [float(value) for value in args.bbox.split(",")]
+            except ValueError:
+                bbox = []
+            if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                print("illegal value for bbox, expected MINLON,MINLAT,MAXLON,MAXLAT: %s" % args.bbox)
+                sys.exit(-1)
+        for date in (args.start_date, args.end_date):
+            if date:
+                try:
+                    iso_timestamp(date)
+                except ValueError:
+                    print("illegal date, expected YYYY-MM-DD: %s" % date)
+                    sys.exit(-1)
+        exit(query_index(args.output_folder, bbox, args.start_date, args.end_date, args.sequence))
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + (" " + command if command else ""),
+        description=(commands[command] if command else "Download your images from Mapillary")
+        + ", version: " + VERSION,
+        epilog="commands: " + ", ".join("%s: %s" % item for item in commands.items()),
+    )
     parser.add_argument("email", help="Your email address for mapillary authentication")
     parser.add_argument("password", help="Your mapillary password")
     parser.add_argument("username", help="Your mapillary username")
@@ -494,12 +3637,46 @@ if __name__ == "__main__":
     parser.add_argument( "--timeout", metavar="1..300",  help="set connection/read timeout in seconds, default: " + str(DOWNLOAD_FILE_TIMEOUT))
     parser.add_argument( "--timeout-meta", metavar="1..300",  help="set connection/read timeout for meta requests in seconds, default: " + str(META_TIMEOUT))
     parser.add_argument( "--threads", metavar="1..128",  help="number of threads, default: " + str(NUM_THREADS))
-    parser.add_argument( "--retries", metavar="1..512",  help="sequence max. retries, default: " + str(SEQUENCE_DL_MAX_RETRIES))
+    parser.add_argument( "--engine", choices=["threads", "async"],  help="download engine, async requires aiohttp, default: " + ENGINE)
+    parser.add_argument( "--concurrency", metavar="1..10000",  help="downloads in flight for the async engine, default: " + str(ASYNC_CONCURRENCY))
+    parser.add_argument( "--adaptive", action="store_true", help="Adapt the number of active downloads to errors, timeouts and throughput, default: " + str(ADAPTIVE))
+    parser.add_argument( "--min-workers", metavar="1..10000",  help="lower bound for --adaptive, default: " + str(ADAPTIVE_MIN))
+    parser.add_argument( "--max-workers", metavar="1..10000",  help="upper bound for --adaptive, default: 128 threads or 10000 async")
+    parser.add_argument( "--max-bandwidth", metavar="Mbit/s",  help="download bandwidth of all threads together, 0: unlimited, default: " + str(MAX_BANDWIDTH))
+    parser.add_argument( "--meta-rate", metavar="1/s",  help="max. login, sequence and model requests per second, 0: unlimited, default: " + str(META_RATE))
+    parser.add_argument( "--url-threads", metavar="1..32",  help="number of parallel source URL requests, default: " + str(URL_THREADS))
+    parser.add_argument( "--pool-size", metavar="1..512",  help="keep-alive connections per host, default: same as threads")
+    parser.add_argument( "--buffer-size", metavar="4..4096",  help="download buffer size in KB, default: " + str(DOWNLOAD_BUFFER_SIZE // 1024))
+    parser.add_argument( "--retries", metavar="1..512",  help="max. download attempts per image, default: " + str(IMAGE_DL_MAX_RETRIES))
     parser.add_argument(
         "-D", "--dry-run", action="store_true", help="Check sequences status, display estimates and leave"
     )
+    parser.add_argument( "--size-sample", metavar="0..1",  help="dry run: share of the images whose size is probed on the server, 1: all, default: " + str(SIZE_SAMPLE))
+    parser.add_argument( "--api-endpoint", metavar="URL",  help="Mapillary API server, default: " + API_ENDPOINT)
+    parser.add_argument( "--metrics-file", metavar="FILE",  help="append metric events as JSON lines to this file")
+    parser.add_argument( "--prometheus-file", metavar="FILE",  help="write metrics in Prometheus text format to this file")
+    parser.add_argument( "--full-refresh", action="store_true", help="Fetch the full sequence list instead of only sequences created since the last run, default: " + str(FULL_REFRESH))
+    parser.add_argument( "--order", choices=["newest", "oldest", "smallest", "date"],  help="order of the sequences: newest or oldest created first, smallest download first or by capture date, all but newest wait for the full sequence list, default: " + ORDER)
+    parser.add_argument( "--oldest-first", action="store_true", help="same as --order oldest")
+    parser.add_argument( "--max-bytes", metavar="SIZE",  help="download budget, e.g. 500M or 20G, sequences which don't fit are left for the next run, default: unlimited")
+    parser.add_argument( "--max-duration", metavar="TIME",  help="time budget, e.g. 90m or 6h, sequences which are not expected to finish in time are left for the next run, default: unlimited")
+    parser.add_argument( "--verify", action="store_true", help="Cross-check the download manifest with the image sizes on disk, see the verify command for a full check, default: " + str(VERIFY))
     parser.add_argument( "--subfolder", action="store_true", help="Store images by date and sequence subfolders, default: " + str(SUBFOLDER))
-    args = parser.parse_args()
+    parser.add_argument( "--pack", choices=["day", "sequence"],  help="append the images to tar shards per day or per sequence with an index instead of one file per image")
+    parser.add_argument( "--pack-size", metavar="MB",  help="max. size of a tar shard, default: " + str(PACK_SIZE // 1024 // 1024))
+    parser.add_argument( "--workers", metavar="1..1024",  help="start this number of worker processes which share the takeout")
+    parser.add_argument( "--shard", metavar="I/N",  help="download shard I of N, e.g. one shard per host, default: 1/1")
+    parser.add_argument( "--shard-by", choices=["key", "date"],  help="split the sequences into shards by sequence key or capture date, default: " + SHARD_BY)
+    parser.add_argument( "--lease", action="store_true", help="Claim sequences through leases in the manifest and continue with the other shards when done, default: " + str(LEASES))
+    parser.add_argument( "--worker-id", metavar="ID",  help="name of this worker in the leases, default: hostname:pid")
+    parser.add_argument( "--lease-ttl", metavar="10..86400",  help="seconds until the leases of a crashed worker expire, default: " + str(LEASE_TTL))
+    parser.add_argument( "--no-wal", action="store_true", help="Disable the manifest WAL journal, required if workers on several hosts share the output folder")
+    verify = parser.add_argument_group("verify command")
+    verify.add_argument( "--processes", metavar="1..1024",  help="number of processes which check the images, default: one per CPU")
+    verify.add_argument( "--remote", action="store_true", help="Compare the image sizes with the server, default: " + str(VERIFY_REMOTE))
+    verify.add_argument( "--checksum", action="store_true", help="Compare the MD5 of the images with the ETag on the server, implies --remote, default: " + str(VERIFY_CHECKSUM))
+    verify.add_argument( "--repair", action="store_true", help="Download the failing images again right away instead of with the next takeout, default: " + str(VERIFY_REPAIR))
+    args = parser.parse_args(argv)
 
     if args.dry_run:
         DRY_RUN = True
@@ -507,6 +3684,72 @@ if __name__ == "__main__":
     if args.subfolder:
         SUBFOLDER = True
 
+    if args.pack:
+        PACK_BY = args.pack
+
+    if args.pack_size:
+        try:
+            pack_size = int(args.pack_size)
+        except:
+            print("illegal value for pack size: %s" % args.pack_size)
+            sys.exit(-1)
+        if pack_size > 0:
+            PACK_SIZE = pack_size * 1024 * 1024
+        else:
+            print ("pack size parameter is out of range: %s, ignored" % pack_size)
+
+    if args.size_sample:
+        try:
+            size_sample = float(args.size_sample)
+        except:
+            print("illegal value for size sample: %s" % args.size_sample)
+            sys.exit(-1)
+        if size_sample >= 0 and size_sample <= 1:
+            SIZE_SAMPLE = size_sample
+        else:
+            print ("size sample parameter is out of range 0..1: %s, ignored" % size_sample)
+
+    if args.verify:
+        VERIFY = True
+
+    if args.full_refresh:
+        FULL_REFRESH = True
+    if args.oldest_first:
+        ORDER = "oldest"
+    if args.order:
+        ORDER = args.order
+
+    if args.max_bytes:
+        try:
+            max_bytes = parse_unit(args.max_bytes, {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4})
+        except ValueError:
+            print("illegal value for max bytes: %s" % args.max_bytes)
+            sys.exit(-1)
+        if max_bytes > 0:
+            MAX_BYTES = max_bytes
+        else:
+            print ("max bytes parameter is out of range: %s, ignored" % args.max_bytes)
+
+    if args.max_duration:
+        try:
+            max_duration = parse_unit(args.max_duration, {"s": 1, "m": 60, "h": 3600, "d": 86400})
+        except ValueError:
+            print("illegal value for max duration: %s" % args.max_duration)
+            sys.exit(-1)
+        if max_duration > 0:
+            MAX_DURATION = max_duration
+        else:
+            print ("max duration parameter is out of range: %s, ignored" % args.max_duration)
+
+    if args.api_endpoint:
+        set_api_endpoint(args.api_endpoint)
+
+    if args.metrics_file:
+        METRICS_FILE = args.metrics_file
+
+    if args.prometheus_file:
+        PROMETHEUS_FILE = args.prometheus_file
+
     if args.debug:
         try:
             debug = int(args.debug)
@@ -551,6 +3794,110 @@ if __name__ == "__main__":
         else:
             print ("timeout parameter is out of range 0..128: %s, ignored" % threads)
             
+    if args.engine:
+        ENGINE = args.engine
+        if ENGINE == "async":
+            try:
+                import aiohttp
+            except ImportError:
+                print("The async engine requires the aiohttp library: python3 -m pip install aiohttp")
+                sys.exit(-1)
+
+    if args.concurrency:
+        try:
+            concurrency = int(args.concurrency)
+        except:
+            print("illegal value for concurrency: %s" % args.concurrency)
+            sys.exit(-1)
+        if concurrency > 0 and concurrency <= 10000:
+            ASYNC_CONCURRENCY = concurrency
+        else:
+            print ("concurrency parameter is out of range 1..10000: %s, ignored" % concurrency)
+
+    if args.adaptive:
+        ADAPTIVE = True
+
+    if args.min_workers:
+        try:
+            min_workers = int(args.min_workers)
+        except:
+            print("illegal value for min workers: %s" % args.min_workers)
+            sys.exit(-1)
+        if min_workers > 0 and min_workers <= 10000:
+            ADAPTIVE_MIN = min_workers
+        else:
+            print ("min workers parameter is out of range 1..10000: %s, ignored" % min_workers)
+
+    if args.max_workers:
+        try:
+            max_workers = int(args.max_workers)
+        except:
+            print("illegal value for max workers: %s" % args.max_workers)
+            sys.exit(-1)
+        if max_workers > 0 and max_workers <= 10000:
+            ADAPTIVE_MAX = max_workers
+        else:
+            print ("max workers parameter is out of range 1..10000: %s, ignored" % max_workers)
+
+    if ADAPTIVE_MAX and ADAPTIVE_MIN > ADAPTIVE_MAX:
+        print("min workers %d is larger than max workers %d" % (ADAPTIVE_MIN, ADAPTIVE_MAX))
+        sys.exit(-1)
+
+    if args.max_bandwidth:
+        try:
+            max_bandwidth = float(args.max_bandwidth)
+        except:
+            print("illegal value for max bandwidth: %s" % args.max_bandwidth)
+            sys.exit(-1)
+        if max_bandwidth >= 0:
+            set_max_bandwidth(max_bandwidth)
+        else:
+            print ("max bandwidth parameter is negative: %s, ignored" % max_bandwidth)
+
+    if args.meta_rate:
+        try:
+            meta_rate = float(args.meta_rate)
+        except:
+            print("illegal value for meta rate: %s" % args.meta_rate)
+            sys.exit(-1)
+        if meta_rate >= 0:
+            set_meta_rate(meta_rate)
+        else:
+            print ("meta rate parameter is negative: %s, ignored" % meta_rate)
+
+    if args.url_threads:
+        try:
+            url_threads = int(args.url_threads)
+        except:
+            print("illegal value for url threads: %s" % args.url_threads)
+            sys.exit(-1)
+        if url_threads > 0 and url_threads <= 32:
+            URL_THREADS = url_threads
+        else:
+            print ("url threads parameter is out of range 1..32: %s, ignored" % url_threads)
+
+    if args.pool_size:
+        try:
+            pool_size = int(args.pool_size)
+        except:
+            print("illegal value for pool size: %s" % args.pool_size)
+            sys.exit(-1)
+        if pool_size > 0 and pool_size <= 512:
+            HTTP_POOL_SIZE = pool_size
+        else:
+            print ("pool size parameter is out of range 0..512: %s, ignored" % pool_size)
+
+    if args.buffer_size:
+        try:
+            buffer_size = int(args.buffer_size)
+        except:
+            print("illegal value for buffer size: %s" % args.buffer_size)
+            sys.exit(-1)
+        if buffer_size >= 4 and buffer_size <= 4096:
+            DOWNLOAD_BUFFER_SIZE = buffer_size * 1024
+        else:
+            print ("buffer size parameter is out of range 4..4096: %s, ignored" % buffer_size)
+
     if args.retries:
         try:
             retries = int(args.retries)
@@ -558,15 +3905,97 @@ if __name__ == "__main__":
             print("illegal value for retries: %s" % args.retries)
             sys.exit(-1)
         if retries > 0 and retries <= 512:
-            SEQUENCE_DL_MAX_RETRIES = retries
+            IMAGE_DL_MAX_RETRIES = retries
         else:
             print ("retries parameter is out of range 0..512: %s, ignored" % retries)
 
+    if args.shard:
+        try:
+            shard, shards = [int(x) for x in args.shard.split("/")]
+        except:
+            print("illegal value for shard: %s" % args.shard)
+            sys.exit(-1)
+        if shards < 1 or shards > 1024 or shard < 1 or shard > shards:
+            print("shard parameter is out of range 1/1..1024/1024: %s" % args.shard)
+            sys.exit(-1)
+        SHARD, SHARDS = shard - 1, shards
+
+    if args.shard_by:
+        SHARD_BY = args.shard_by
+
+    if args.lease:
+        LEASES = True
+
+    if args.worker_id:
+        WORKER_ID = args.worker_id
+
+    if args.lease_ttl:
+        try:
+            lease_ttl = int(args.lease_ttl)
+        except:
+            print("illegal value for lease ttl: %s" % args.lease_ttl)
+            sys.exit(-1)
+        if lease_ttl >= 10 and lease_ttl <= 86400:
+            LEASE_TTL = lease_ttl
+        else:
+            print ("lease ttl parameter is out of range 10..86400: %s, ignored" % lease_ttl)
+
+    if args.no_wal:
+        MANIFEST_WAL = False
+
+    if args.processes:
+        try:
+            processes = int(args.processes)
+        except:
+            print("illegal value for processes: %s" % args.processes)
+            sys.exit(-1)
+        if processes > 0 and processes <= 1024:
+            VERIFY_PROCESSES = processes
+        else:
+            print ("processes parameter is out of range 1..1024: %s, ignored" % processes)
+
+    if args.remote:
+        VERIFY_REMOTE = True
+
+    if args.checksum:
+        VERIFY_REMOTE = VERIFY_CHECKSUM = True
+
+    if args.repair:
+        VERIFY_REPAIR = True
+
+    if command == "verify":
+        exit(run_command(verify_archive, args.email, args.password, args.username, args.output_folder,
+                         args.start_date, args.end_date))
+
+    if args.workers and not DRY_RUN:
+        try:
+            workers = int(args.workers)
+        except:
+            print("illegal value for workers: %s" % args.workers)
+            sys.exit(-1)
+        if workers < 1 or workers > 1024:
+            print("workers parameter is out of range 1..1024: %s" % workers)
+            sys.exit(-1)
+        # the workers get the same options, only their own shard, and
+        # start from the sequence list cached by the coordinator
+        worker_args = []
+        skip = False
+        for arg in sys.argv[1:]:
+            if skip:
+                skip = False
+            elif arg in ("--workers", "--shard", "--worker-id"):
+                skip = True
+            elif arg.split("=")[0] not in ("--workers", "--shard", "--worker-id", "--full-refresh", "--lease"):
+                worker_args.append(arg)
+        exit(run_command(run_workers, workers, args.email, args.password, args.username, args.output_folder,
+                         args.start_date, args.end_date, worker_args))
+
     if DEBUG > 0:
-        print("number of threads: %d, connection timeout: %2.1f sec., retries: %d, debug: %d, with subfolder: %s" % (NUM_THREADS, DOWNLOAD_FILE_TIMEOUT, SEQUENCE_DL_MAX_RETRIES, DEBUG, SUBFOLDER))
+        print("engine: %s, number of threads: %d, pool size: %d, connection timeout: %2.1f sec., retries: %d, debug: %d, with subfolder: %s" % (ENGINE, NUM_THREADS, HTTP_POOL_SIZE or NUM_THREADS, DOWNLOAD_FILE_TIMEOUT, IMAGE_DL_MAX_RETRIES, DEBUG, SUBFOLDER))
         
     exit(
-        main(
+        run_command(
+            main,
             args.email,
             args.password,
             args.username,
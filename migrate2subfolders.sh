@@ -5,50 +5,12 @@
 #
 # usage: cd /mnt/mapillary-disk && migrate2subfolders.sh
 #
-
+# The images are moved by the migrate-layout command of mapillary_takeout.py,
+# which is resumed after an interruption and keeps the download manifest up to date.
+#
 
 set -e
 
-# create subfolders first
-create_subfolder ()
-  {
-  for j in 20??-*
-  do 
-  (
-    cd $j
-    pwd
-    mkdir -p $(ls | sed -e 's,Z.*,Z,'|sort -u)
-  )
-  done
-}
-
-# move images to subfolders
-move_images ()
-{
-  for j in 20??-*
-  do 
-  (
-    cd $j
-    if ls | grep -q jpg; then
-      pwd
-      for i in $(ls | grep '\.jpg$' | sed -e 's,Z.*,Z,'| sort -u)
-      do
-        echo $i
-        for k in 0 1 2 3 4 5 6 7 8 9
-        do 
-          if ls | grep -q "${i}.*$k.jpg"; then 
-            printf "."
-            mv ${i}_*${k}.jpg $i
-          fi
-        done
-        echo ""
-      done
-    fi
-  )
-  done
-}
-
-create_subfolder
-move_images
+exec python3 "$(dirname "$0")/mapillary_takeout.py" migrate-layout --to subfolder .
 
 #EOF